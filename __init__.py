@@ -3,12 +3,20 @@
 # the full copyright notices and license terms.
 from trytond.pool import Pool
 from . import ir
+from . import migration
 from . import routes
+from . import similarity
 from .encryption import FernetEncryptionMixin
+from .similarity import SimilarityMixin, trigram_index
 
-__all__ = ['register', 'routes', 'FernetEncryptionMixin']
+__all__ = ['register', 'routes', 'FernetEncryptionMixin', 'SimilarityMixin',
+    'trigram_index']
 
 def register():
     Pool.register(
         ir.View,
+        ir.Attachment,
+        ir.Cron,
+        migration.MigrationCheckpoint,
+        similarity.Trigram,
         module='widgets', type_='model')
@@ -0,0 +1,121 @@
+# This file is part widgets module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+JSON codec of the EditorJS documents using orjson when it is installed and
+cheap operations on their blocks which do not decode the whole document
+'''
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError is a subclass
+JSONDecodeError = json.JSONDecodeError
+
+_SCALAR = r'(?:"(?:[^"\\]|\\.)*"|-?[\d.eE+-]+|true|false|null)'
+_MEMBER = r'"(?:[^"\\]|\\.)*"\s*:\s*' + _SCALAR
+# The start of a document with only scalar members before its blocks
+_BLOCKS_START = re.compile(
+    r'\s*\{(?:\s*' + _MEMBER + r'\s*,)*\s*"blocks"\s*:\s*\[\s*')
+# The end of a document with only scalar members after its blocks
+_BLOCKS_END = re.compile(r'\](?:\s*,\s*' + _MEMBER + r')*\s*\}\s*$')
+
+
+if orjson:
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+    dumpb = orjson.dumps
+else:
+    loads = json.loads
+    dumps = json.dumps
+
+    def dumpb(obj):
+        return json.dumps(obj).encode('utf-8')
+
+
+def _blocks_start(document):
+    "Returns the index of the content of the blocks array or None"
+    match = _BLOCKS_START.match(document)
+    if match:
+        return match.end()
+
+
+def _blocks_span(document):
+    '''
+    Returns the start and end indexes of the content of the blocks array of
+    the document or None if they can not be found without decoding
+    '''
+    start = _blocks_start(document)
+    if start is None:
+        return
+    # Only scalar members follow the blocks so the first "]" from the end
+    # which is followed by them closes the array
+    index = document.rfind(']', start)
+    while index >= start:
+        if _BLOCKS_END.match(document, index):
+            return start, len(document[start:index].rstrip()) + start
+        index = document.rfind(']', start, index)
+
+
+def is_document(text):
+    "Tests if the text is an EditorJS document"
+    if _blocks_start(text) is not None:
+        return True
+    if not text.lstrip().startswith('{'):
+        return False
+    try:
+        content = loads(text)
+    except JSONDecodeError:
+        return False
+    return isinstance(content, dict) and 'blocks' in content
+
+
+def has_blocks(document):
+    "Tests if the document has at least one block"
+    if not document:
+        return False
+    start = _blocks_start(document)
+    if start is not None:
+        return not document.startswith(']', start)
+    return bool(loads(document).get('blocks'))
+
+
+def count_blocks(document):
+    "Returns the number of blocks of the document"
+    if not document:
+        return 0
+    start = _blocks_start(document)
+    if start is not None and document.startswith(']', start):
+        return 0
+    return len(loads(document).get('blocks') or [])
+
+
+def concat_blocks(document1, document2):
+    '''
+    Returns document1 with the blocks of document2 appended
+
+    The documents are spliced as strings when their structure allows it.
+    '''
+    if not document1:
+        return document2
+    if not document2:
+        return document1
+    span1, span2 = _blocks_span(document1), _blocks_span(document2)
+    if span1 and span2:
+        blocks = document2[span2[0]:span2[1]]
+        if not blocks:
+            return document1
+        if span1[0] != span1[1]:
+            blocks = ', ' + blocks
+        return document1[:span1[1]] + blocks + document1[span1[1]:]
+    content1, content2 = loads(document1), loads(document2)
+    content1['blocks'] += content2['blocks']
+    return dumps(content1)
@@ -1,10 +1,127 @@
-from cryptography.fernet import Fernet, InvalidToken
+import hashlib
+import hmac
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from sql import Column, For, Null
 import trytond.config as config
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
-from trytond.model import fields
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from . import tools
+
+logger = logging.getLogger(__name__)
+
+# The keys are separated by commas or spaces, the first one encrypts and all
+# of them decrypt so the previous keys stay readable during a rotation
+FERNET_KEYS = tuple(k for k in re.split(
+        r'[\s,]+', config.get('cryptography', 'fernet_key') or '') if k)
+FERNET_KEY = FERNET_KEYS[0] if FERNET_KEYS else None
+# Number of threads used to decrypt batches of at least FERNET_THREAD_MIN
+# values, cryptography releases the GIL
+FERNET_THREADS = config.getint('cryptography', 'fernet_threads', default=0)
+FERNET_THREAD_MIN = config.getint(
+    'cryptography', 'fernet_thread_min', default=1000)
+# The key of the HMAC stored in the <name>_blind columns to search encrypted
+# values, it must differ from the Fernet keys
+BLIND_INDEX_KEY = config.get('cryptography', 'blind_index_key')
+# Number of normalized characters hashed in the <name>_blind_prefix columns
+BLIND_PREFIX_LENGTH = config.getint(
+    'cryptography', 'blind_index_prefix_length', default=4)
+
+
+@lru_cache(maxsize=None)
+def _fernet(keys):
+    return MultiFernet([Fernet(k) for k in keys])
+
+
+def rotate_tokens(tokens, keys=None):
+    '''
+    Returns the list of (id, token) re-encrypted with the primary key for the
+    (id, token) which are not already signed by it
+    '''
+    keys = tuple(keys or FERNET_KEYS)
+    primary, fernet = _fernet(keys[:1]), _fernet(keys)
+    rotated = []
+    for id_, token in tokens:
+        token = bytes(token)
+        try:
+            # Only checks the signature which is cheaper than decrypting
+            primary.extract_timestamp(token)
+            continue
+        except InvalidToken:
+            pass
+        try:
+            rotated.append((id_, fernet.rotate(token)))
+        except InvalidToken:
+            logger.warning('could not rotate invalid token of id %s', id_)
+    return rotated
 
-FERNET_KEY = config.get('cryptography', 'fernet_key')
+
+def rotate_column(sql_table, column, batch_size=1000):
+    '''
+    Re-encrypts with the primary key the tokens of column of sql_table.
+
+    Rows are read in batches of batch_size ordered by id and every batch is
+    updated and committed together with a checkpoint, so an interrupted
+    rotation resumes after the last committed batch. The rows of a batch are
+    locked until it is committed so concurrent writes are not overwritten
+    with the rotated old value.
+    '''
+    pool = Pool()
+    Checkpoint = pool.get('widgets.migration.checkpoint')
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    field = Column(sql_table, column)
+    for_ = For('UPDATE') if transaction.database.has_select_for() else None
+
+    table_name = sql_table._name
+    last_id = Checkpoint.get_last_id(table_name, column)
+    done = rotated = 0
+    while True:
+        cursor.execute(*sql_table.select(sql_table.id, field,
+                where=(field != Null) & (sql_table.id > last_id),
+                order_by=sql_table.id.asc, limit=batch_size, for_=for_))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        values = rotate_tokens(rows)
+        tools.bulk_update(sql_table, field, values)
+        Checkpoint.set_last_id(table_name, column, last_id)
+        transaction.connection.commit()
+        done += len(rows)
+        rotated += len(values)
+        logger.info('%s.%s: %s rows, %s rotated',
+            table_name, column, done, rotated)
+    Checkpoint.set_last_id(table_name, column, None)
+
+
+def rotate_fernet_keys(batch_size=1000):
+    '''
+    Re-encrypts with the primary key all the encrypted columns of the models
+    using FernetEncryptionMixin
+    '''
+    if len(FERNET_KEYS) < 2:
+        return
+    pool = Pool()
+    for _, Model in pool.iterobject():
+        if (not issubclass(Model, FernetEncryptionMixin)
+                or not issubclass(Model, ModelSQL)
+                or Model.table_query()):
+            continue
+        for name, field in Model._fields.items():
+            if (not name.endswith('_encrypted')
+                    or isinstance(field, fields.Function)
+                    or getattr(field, 'file_id', None)):
+                continue
+            rotate_column(Model.__table__(), name, batch_size=batch_size)
 
 
 class FernetEncryptionMixin:
@@ -12,9 +129,9 @@ class FernetEncryptionMixin:
 
     @classmethod
     def get_fernet(cls):
-        if not FERNET_KEY:
+        if not FERNET_KEYS:
             raise UserError(gettext('widgets.msg_missing_fernet_key'))
-        return Fernet(FERNET_KEY)
+        return _fernet(FERNET_KEYS)
 
     def get_fernet_value(self, name):
         if not name.endswith('_decrypted'):
@@ -26,24 +143,66 @@ class FernetEncryptionMixin:
                 'widgets.msg_unknown_decrypted_field',
                 field=clear_name))
 
+        # The browse cache loads the encrypted values of all the records
         encrypted_name = '%s_encrypted' % clear_name
         encrypted_value = getattr(self, encrypted_name, None)
         if not encrypted_value:
             return None
+        decrypted, = self._fernet_decrypt([bytes(encrypted_value)], clear_name)
+        if isinstance(self._fields[clear_name], fields.Binary):
+            return decrypted
+        return decrypted.decode('utf-8')
+
+    @classmethod
+    def get_fernet_values(cls, records, names):
+        result = {}
+        ids = [r.id for r in records]
+        decrypted = {}
+        for name in names:
+            if not name.endswith('_decrypted'):
+                result[name] = dict.fromkeys(ids, 'x' * 10)
+                continue
+            clear_name = name[:-10]
+            if clear_name not in cls._fields:
+                raise UserError(gettext(
+                    'widgets.msg_unknown_decrypted_field',
+                    field=clear_name))
+            decrypted[name] = clear_name
+        if not decrypted:
+            return result
+
+        encrypted_names = {n: '%s_encrypted' % c for n, c in decrypted.items()}
+        rows = cls.read(ids, list(set(encrypted_names.values())))
+        for name, clear_name in decrypted.items():
+            encrypted_name = encrypted_names[name]
+            tokens = [(r['id'], r[encrypted_name]) for r in rows
+                if r[encrypted_name]]
+            values = cls._fernet_decrypt(
+                [bytes(t) for _, t in tokens], clear_name)
+            if not isinstance(cls._fields[clear_name], fields.Binary):
+                values = [v.decode('utf-8') for v in values]
+            result[name] = dict.fromkeys(ids)
+            result[name].update(zip((i for i, _ in tokens), values))
+        return result
+
+    @classmethod
+    def _fernet_decrypt(cls, tokens, clear_name):
+        fernet = cls.get_fernet()
         try:
-            decrypted = self.get_fernet().decrypt(bytes(encrypted_value))
+            if FERNET_THREADS and len(tokens) >= FERNET_THREAD_MIN:
+                with ThreadPoolExecutor(max_workers=FERNET_THREADS) as pool:
+                    return list(pool.map(fernet.decrypt, tokens))
+            return [fernet.decrypt(t) for t in tokens]
         except InvalidToken as exc:
             raise UserError(gettext(
                     'widgets.msg_invalid_fernet_token',
                     field=clear_name)) from exc
-        if isinstance(self._fields[clear_name], fields.Binary):
-            return decrypted
-        return decrypted.decode('utf-8')
 
     @classmethod
     def set_fernet_value(cls, records, name, value):
         if value == 'x' * 10:
             return
+        values = cls._blind_index_values(name, value)
         if value:
             if not isinstance(value, bytes):
                 value = value.encode('utf-8')
@@ -51,4 +210,103 @@ class FernetEncryptionMixin:
         else:
             encrypted_value = None
         encrypted_name = '%s_encrypted' % name
-        cls.write(records, {encrypted_name: encrypted_value})
+        values[encrypted_name] = encrypted_value
+        cls.write(records, values)
+
+    @classmethod
+    def normalize_blind_value(cls, name, value):
+        "Return the value of field name as hashed in the blind index"
+        if isinstance(value, str):
+            value = re.sub(r'\s+', '', value).upper()
+        return value
+
+    @classmethod
+    def _blind_hash(cls, value):
+        if not BLIND_INDEX_KEY:
+            raise UserError(gettext('widgets.msg_missing_blind_index_key'))
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return hmac.new(BLIND_INDEX_KEY.encode('utf-8'), value,
+            hashlib.sha256).hexdigest()
+
+    @classmethod
+    def _blind_index_values(cls, name, value):
+        '''
+        Returns the values of the <name>_blind and <name>_blind_prefix fields
+        defined on the model for the clear value of field name
+        '''
+        values = {}
+        blind_name = '%s_blind' % name
+        prefix_name = '%s_blind_prefix' % name
+        if value:
+            value = cls.normalize_blind_value(name, value)
+        if blind_name in cls._fields:
+            values[blind_name] = cls._blind_hash(value) if value else None
+        if prefix_name in cls._fields:
+            values[prefix_name] = (
+                cls._blind_hash(value[:BLIND_PREFIX_LENGTH])
+                if value and len(value) >= BLIND_PREFIX_LENGTH else None)
+        return values
+
+    @classmethod
+    def update_blind_index(cls, records):
+        "Fill the blind index columns of the records from their clear values"
+        names = [n[:-10] for n in cls._fields
+            if n.endswith('_encrypted')
+            and cls._blind_index_values(n[:-10], None)]
+        if not records or not names:
+            return
+        decrypted_names = ['%s_decrypted' % n for n in names]
+        values = cls.get_fernet_values(records, decrypted_names)
+        to_write = []
+        for record in records:
+            record_values = {}
+            for name, decrypted_name in zip(names, decrypted_names):
+                record_values.update(cls._blind_index_values(
+                        name, values[decrypted_name][record.id]))
+            to_write.extend(([record], record_values))
+        cls.write(*to_write)
+
+    @classmethod
+    def search_fernet_value(cls, name, clause):
+        '''
+        Searches the encrypted values of field name with the <name>_blind
+        column for the equality operators and with the <name>_blind_prefix
+        column for the "like" operators on a prefix.
+
+        Values are compared once normalized by normalize_blind_value.
+        '''
+        _, operator, value = clause[:3]
+        if name.endswith('_decrypted'):
+            name = name[:-10]
+        blind_name = '%s_blind' % name
+        prefix_name = '%s_blind_prefix' % name
+        if operator in {'=', '!='} and blind_name in cls._fields:
+            if not value:
+                return [('%s_encrypted' % name, operator, None)]
+            return [(blind_name, operator,
+                    cls._blind_hash(cls.normalize_blind_value(name, value)))]
+        elif operator in {'in', 'not in'} and blind_name in cls._fields:
+            return [(blind_name, operator, [
+                        cls._blind_hash(cls.normalize_blind_value(name, v))
+                        for v in value if v])]
+        elif (operator in {'like', 'ilike'}
+                and prefix_name in cls._fields
+                and isinstance(value, str)
+                and value.endswith('%')
+                and not re.search(r'[%_\\]', value[:-1])):
+            prefix = cls.normalize_blind_value(name, value[:-1])
+            if len(prefix) >= BLIND_PREFIX_LENGTH:
+                records = cls.search([
+                        (prefix_name, '=',
+                            cls._blind_hash(prefix[:BLIND_PREFIX_LENGTH])),
+                        ])
+                decrypted_name = '%s_decrypted' % name
+                values = cls.get_fernet_values(
+                    records, [decrypted_name])[decrypted_name]
+                return [('id', 'in', [id_ for id_, v in values.items()
+                            if v and cls.normalize_blind_value(
+                                name, v).startswith(prefix)])]
+        raise UserError(gettext(
+                'widgets.msg_unsupported_fernet_search',
+                field=name, operator=operator))
@@ -0,0 +1,176 @@
+# This file is part widgets module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+
+import trytond.config as config
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+VARIANT_PATH = config.get('widgets', 'image_variant_path',
+    default=os.path.join(
+        config.get('database', 'path') or tempfile.gettempdir(),
+        'widgets_variants'))
+VARIANT_SIZE_LIMIT = config.getint('widgets', 'image_variant_size_limit',
+    default=512 * 1024 * 1024)
+VARIANT_QUALITY = config.getint('widgets', 'image_variant_quality',
+    default=85)
+MAX_WIDTH = 4096
+# The requested widths are rounded up to these ones to bound the number of
+# variants of each image
+VARIANT_WIDTHS = sorted({int(w) for w in re.split(r'[\s,]+', config.get(
+                'widgets', 'image_variant_widths',
+                default='160 320 480 640 800 1024 1280 1600 1920 2560'))
+        if w} | {MAX_WIDTH})
+FORMATS = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    }
+
+
+def resize_image(data, width):
+    '''
+    Returns the data and the mimetype of the image downscaled to width or
+    None if data is not an image or is not larger than width
+    '''
+    if Image is None or not data:
+        return
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception:
+        return
+    if image.width <= width:
+        return
+    format_ = image.format if image.format in FORMATS else 'PNG'
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((width, image.height), Image.LANCZOS)
+    if format_ == 'JPEG' and image.mode not in {'RGB', 'L'}:
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format=format_, quality=VARIANT_QUALITY, optimize=True)
+    return output.getvalue(), FORMATS[format_]
+
+
+def variant_width(width):
+    "Returns the width of the variant used for width"
+    width = min(width, MAX_WIDTH)
+    return next(w for w in VARIANT_WIDTHS if w >= width)
+
+
+def _variant_path(digest, width):
+    key = hashlib.sha256(('%s/%s' % (digest, width)).encode('utf-8'))
+    key = key.hexdigest()
+    return os.path.join(VARIANT_PATH, key[:2], key)
+
+
+# Size of the variants when last walked plus the ones written since by the
+# process, None until the first walk
+_size = None
+
+
+def _evict(limit=None):
+    "Remove the least recently used variants until the cache fits limit"
+    global _size
+    if limit is None:
+        limit = VARIANT_SIZE_LIMIT
+    files = []
+    total = 0
+    for root, _, names in os.walk(VARIANT_PATH):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    files.sort()
+    for _, size, path in files:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    _size = total
+
+
+def _add_size(size):
+    "Evicts variants when the estimated cache size exceeds the limit"
+    global _size
+    if _size is not None:
+        _size += size
+    if _size is None or _size > VARIANT_SIZE_LIMIT:
+        # Leave room to not walk the cache again on the next writes
+        _evict(VARIANT_SIZE_LIMIT * 9 // 10)
+
+
+def get_variant(attachment, width, data=None):
+    '''
+    Returns the data and the mimetype of the attachment image downscaled to
+    width or None if it is not a resizable image.
+
+    Variants are cached on disk keyed by the digest of the attachment and the
+    width rounded up by variant_width as well as the images which can not be
+    resized. data is the attachment data when it is already loaded.
+    '''
+    if Image is None or not width:
+        return
+    mimetype = mimetypes.guess_type(attachment.name or '')[0]
+    if mimetype and not mimetype.startswith('image/'):
+        return
+    width = variant_width(int(width))
+    if attachment.file_id:
+        digest = attachment.file_id
+    else:
+        if data is None:
+            data = attachment.data
+        digest = hashlib.sha256(data or b'').hexdigest()
+    path = _variant_path(digest, width)
+    mimetype_path = path + '.type'
+    try:
+        with open(mimetype_path) as mimetype_file:
+            mimetype = mimetype_file.read()
+        # An empty mimetype marks the attachments which are not resizable
+        if not mimetype:
+            os.utime(mimetype_path)
+            return
+        with open(path, 'rb') as file:
+            os.utime(path)
+            return file.read(), mimetype
+    except OSError:
+        pass
+
+    if data is None:
+        data = attachment.data
+    variant = resize_image(data, width)
+    files = [(mimetype_path, variant[1] if variant else '', 'w')]
+    if variant:
+        files.append((path, variant[0], 'wb'))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for filename, content, mode in files:
+            with tempfile.NamedTemporaryFile(mode, delete=False,
+                    dir=os.path.dirname(path)) as file:
+                file.write(content)
+            os.replace(file.name, filename)
+        if variant:
+            _add_size(len(variant[0]) + len(variant[1]))
+    except OSError:
+        logger.warning('Could not cache image variant %s', path,
+            exc_info=True)
+    return variant
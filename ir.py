@@ -1,28 +1,76 @@
+import copy
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+
 from lxml import etree
 
+import trytond.config as config
 from trytond.pool import PoolMeta
 
+from . import encryption, tools
+
+# Number of valid archs remembered by each validator, 0 disables it as
+# keying serializes every arch while most of them are validated only once
+VALIDATOR_CACHE_SIZE = config.getint(
+    'widgets', 'validator_cache_size', default=0)
+
+
+@lru_cache(maxsize=None)
+def _widget_xpath(widgets):
+    return etree.XPath('.//field[%s]' % ' or '.join(
+            '@widget="%s"' % widget for widget in sorted(widgets)))
+
 
 class _WidgetValidator:
     def __init__(self, validator, widgets):
         self._validator = validator
-        self._widgets = widgets
+        self._widgets = frozenset(widgets)
+        self._xpath = _widget_xpath(self._widgets) if widgets else None
+        self._valid = OrderedDict()
 
     def _prepare_tree(self, tree):
-        if not self._widgets:
+        if not self._widgets or not self._xpath(tree):
             return tree
-        tree = etree.fromstring(etree.tostring(tree))
-        widgets = ' or '.join(f'@widget="{widget}"' for widget in self._widgets)
-        for field in tree.xpath(f'.//field[{widgets}]'):
+        tree = copy.deepcopy(tree)
+        for field in self._xpath(tree):
             field.set('widget', 'text')
             field.attrib.pop('language', None)
         return tree
 
+    def _key(self, tree):
+        if VALIDATOR_CACHE_SIZE:
+            return hashlib.sha256(etree.tostring(tree)).digest()
+
+    def _is_known_valid(self, key):
+        try:
+            self._valid.move_to_end(key)
+        except KeyError:
+            return False
+        return True
+
+    def _set_valid(self, key):
+        if key is None:
+            return
+        self._valid[key] = True
+        while len(self._valid) > VALIDATOR_CACHE_SIZE:
+            self._valid.popitem(last=False)
+
     def validate(self, tree):
-        return self._validator.validate(self._prepare_tree(tree))
+        key = self._key(tree)
+        if self._is_known_valid(key):
+            return True
+        result = self._validator.validate(self._prepare_tree(tree))
+        if result:
+            self._set_valid(key)
+        return result
 
     def assertValid(self, tree):
-        return self._validator.assertValid(self._prepare_tree(tree))
+        key = self._key(tree)
+        if self._is_known_valid(key):
+            return
+        self._validator.assertValid(self._prepare_tree(tree))
+        self._set_valid(key)
 
     @property
     def error_log(self):
@@ -43,3 +91,36 @@ class View(metaclass=PoolMeta):
             key = (cls.__name__, type_)
             validator = cls._get_validator_cache.set(key, validator)
         return validator
+
+
+class Attachment(metaclass=PoolMeta):
+    __name__ = 'ir.attachment'
+
+    @classmethod
+    def write(cls, *args):
+        ids = [a.id for attachments in args[::2] for a in attachments]
+        super().write(*args)
+        tools.render_cache.invalidate_attachments(ids)
+        tools.block_cache.invalidate_attachments(ids)
+
+    @classmethod
+    def delete(cls, attachments):
+        ids = [a.id for a in attachments]
+        super().delete(attachments)
+        tools.render_cache.invalidate_attachments(ids)
+        tools.block_cache.invalidate_attachments(ids)
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('ir.cron|rotate_fernet_keys', "Rotate Fernet Keys"))
+
+    @classmethod
+    def rotate_fernet_keys(cls):
+        "Re-encrypt the encrypted columns with the primary Fernet key"
+        encryption.rotate_fernet_keys()
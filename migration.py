@@ -0,0 +1,40 @@
+# This file is part widgets module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.model import ModelSQL, fields
+
+
+class MigrationCheckpoint(ModelSQL):
+    'Widgets Migration Checkpoint'
+    __name__ = 'widgets.migration.checkpoint'
+    table_name = fields.Char('Table', required=True)
+    column_name = fields.Char('Column', required=True)
+    last_id = fields.Integer('Last ID', required=True)
+
+    @classmethod
+    def get_last_id(cls, table_name, column_name):
+        checkpoints = cls.search([
+                ('table_name', '=', table_name),
+                ('column_name', '=', column_name),
+                ], limit=1)
+        if checkpoints:
+            checkpoint, = checkpoints
+            return checkpoint.last_id
+        return 0
+
+    @classmethod
+    def set_last_id(cls, table_name, column_name, last_id):
+        checkpoints = cls.search([
+                ('table_name', '=', table_name),
+                ('column_name', '=', column_name),
+                ])
+        if last_id is None:
+            cls.delete(checkpoints)
+        elif checkpoints:
+            cls.write(checkpoints, {'last_id': last_id})
+        else:
+            cls.create([{
+                        'table_name': table_name,
+                        'column_name': column_name,
+                        'last_id': last_id,
+                        }])
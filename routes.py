@@ -1,11 +1,161 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime as dt
+import hashlib
+import io
 import mimetypes
+import os
+import uuid
 
+import trytond.config as config
+from trytond.filestore import FileStore, filestore
 from trytond.protocols.wrappers import (
     HTTPStatus, Response, abort, with_pool, with_transaction)
+from trytond.transaction import Transaction
 from trytond.wsgi import app
 
+from . import image
+
+CACHE_CONTROL = config.get(
+    'widgets', 'attachment_cache_control', default='private, no-cache')
+CHUNK_SIZE = config.getint(
+    'widgets', 'attachment_chunk_size', default=64 * 1024)
+
+
+def _attachment_etag(attachment):
+    if attachment.file_id:
+        return attachment.file_id
+    return hashlib.sha256(('%s/%s' % (attachment.id,
+                attachment.write_date or attachment.create_date)
+            ).encode('utf-8')).hexdigest()
+
+
+def _attachment_last_modified(attachment):
+    last_modified = attachment.write_date or attachment.create_date
+    if last_modified:
+        return last_modified.replace(microsecond=0, tzinfo=dt.timezone.utc)
+
+
+def _is_not_modified(request, etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since and last_modified:
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=dt.timezone.utc)
+        return last_modified <= since
+    return False
+
+
+def _attachment_filename(attachment):
+    "Return the path of the attachment file in the filestore or None"
+    # Custom stores which do not read from the file system are skipped
+    if not attachment.file_id or type(filestore).get is not FileStore.get:
+        return
+    prefix = attachment._fields['data'].store_prefix
+    if prefix is None:
+        prefix = Transaction().database.name
+    return filestore._filename(attachment.file_id, prefix)
+
+
+def _open_attachment(attachment):
+    "Return a binary file of the attachment data and its size"
+    filename = _attachment_filename(attachment)
+    if filename:
+        try:
+            file = open(filename, 'rb')
+        except OSError:
+            pass
+        else:
+            return file, os.fstat(file.fileno()).st_size
+    data = attachment.data or b''
+    return io.BytesIO(data), len(data)
+
+
+def _byte_ranges(request, etag, last_modified, size):
+    "Return the list of satisfiable (start, stop) ranges requested"
+    if not request.range or request.range.units != 'bytes':
+        return
+    if_range = request.if_range
+    if if_range.etag and if_range.etag != etag:
+        return
+    if if_range.date and (not last_modified or if_range.date.replace(
+                tzinfo=if_range.date.tzinfo or dt.timezone.utc)
+            != last_modified):
+        return
+    ranges = []
+    for start, stop in request.range.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def _iter_file(file, ranges, boundary=None, mimetype=None, size=None):
+    try:
+        for start, stop in ranges:
+            if boundary:
+                yield _part_header(boundary, mimetype, start, stop, size)
+            file.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        if boundary:
+            yield b'\r\n--%s--\r\n' % boundary
+    finally:
+        file.close()
+
+
+def _part_header(boundary, mimetype, start, stop, size):
+    return (b'\r\n--%s\r\nContent-Type: %s\r\n'
+        b'Content-Range: bytes %d-%d/%d\r\n\r\n') % (
+        boundary, mimetype.encode('latin-1'), start, stop - 1, size)
+
+
+def _stream_response(request, attachment, etag, last_modified):
+    file_mime = mimetypes.guess_type(attachment.name, strict=False)[0]
+    file, size = _open_attachment(attachment)
+    ranges = _byte_ranges(request, etag, last_modified, size)
+    if ranges is None:
+        response = Response(_iter_file(file, [(0, size)]),
+            mimetype=file_mime, direct_passthrough=True)
+        response.content_length = size
+    elif not ranges:
+        file.close()
+        response = Response(status=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+        response.headers['Content-Range'] = 'bytes */%d' % size
+    elif len(ranges) == 1:
+        (start, stop), = ranges
+        response = Response(_iter_file(file, ranges),
+            status=HTTPStatus.PARTIAL_CONTENT, mimetype=file_mime,
+            direct_passthrough=True)
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, stop - 1, size)
+        response.content_length = stop - start
+    else:
+        boundary = uuid.uuid4().hex.encode('ascii')
+        part_mime = file_mime or 'application/octet-stream'
+        length = len(b'\r\n--%s--\r\n' % boundary) + sum(
+            len(_part_header(boundary, part_mime, start, stop, size))
+            + stop - start for start, stop in ranges)
+        response = Response(
+            _iter_file(file, ranges, boundary, part_mime, size),
+            status=HTTPStatus.PARTIAL_CONTENT,
+            mimetype='multipart/byteranges; boundary=%s'
+            % boundary.decode('ascii'),
+            direct_passthrough=True)
+        response.content_length = length
+    response.accept_ranges = 'bytes'
+    return response
+
+
 @app.route('/<database_name>/widgets/attachment/<int:record>')
 @app.auth_required
 @with_pool
@@ -22,5 +172,26 @@ def attachment(request, pool, record):
 
     attachment, = attachments
 
-    file_mime = mimetypes.guess_type(attachment.name, strict=False)[0]
-    return Response(attachment.data, mimetype=file_mime)
+    width = request.args.get('w', type=int)
+    if width is not None:
+        if width <= 0:
+            abort(HTTPStatus.BAD_REQUEST)
+        width = image.variant_width(width)
+
+    # The validators are computed without reading the data from the filestore
+    etag = _attachment_etag(attachment)
+    if width:
+        etag = '%s-w%s' % (etag, width)
+    last_modified = _attachment_last_modified(attachment)
+    if _is_not_modified(request, etag, last_modified):
+        response = Response(status=HTTPStatus.NOT_MODIFIED)
+    elif width and (variant := image.get_variant(attachment, width)):
+        data, mimetype = variant
+        response = Response(data, mimetype=mimetype)
+    else:
+        response = _stream_response(request, attachment, etag, last_modified)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
@@ -0,0 +1,238 @@
+# This file is part widgets module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import math
+from itertools import islice
+
+from sql import Column, Literal
+from sql.aggregate import Count
+
+from trytond import backend
+from trytond.model import Index, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+from . import tools
+
+TRIGRAM_INDEX_METHODS = {'gin', 'gist'}
+# Default threshold of the pg_trgm similarity operator
+SIMILARITY_THRESHOLD = 0.3
+
+
+def trigram_index(field, method='gin'):
+    '''
+    Declares that field needs a trigram index of method (gin or gist) on
+    PostgreSQL or kept in the widgets_trigram table on SQLite and returns the
+    field.
+
+    The gin index is the similarity index of trytond, gist is only needed to
+    order by the distance operator.
+    '''
+    assert method in TRIGRAM_INDEX_METHODS, method
+    field.trigram_index = method
+    return field
+
+
+class Trigram(ModelSQL):
+    'Widgets Trigram'
+    __name__ = 'widgets.trigram'
+    model = fields.Char('Model', required=True)
+    field = fields.Char('Field', required=True)
+    record = fields.Integer('Record', required=True)
+    trigram = fields.Char('Trigram', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.model, Index.Equality(cardinality='low')),
+                    (t.field, Index.Equality(cardinality='low')),
+                    (t.trigram, Index.Equality())),
+                Index(t,
+                    (t.model, Index.Equality(cardinality='low')),
+                    (t.record, Index.Range())),
+                })
+
+
+class SimilarityMixin:
+    __slots__ = ()
+
+    @classmethod
+    def _trigram_fields(cls):
+        return {n: f.trigram_index for n, f in cls._fields.items()
+            if getattr(f, 'trigram_index', None)
+            and not isinstance(f, fields.Function)}
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        table = cls.__table__()
+        for name in dir(cls):
+            field = getattr(cls, name, None)
+            if (isinstance(field, fields.Field)
+                    and not isinstance(field, fields.Function)
+                    and getattr(field, 'trigram_index', None) == 'gin'):
+                cls._sql_indexes.add(Index(table,
+                        (Column(table, name), Index.Similarity())))
+
+    @classmethod
+    def __register__(cls, module_name):
+        indexes = cls._trigram_fields()
+        # The similarity indexes of trytond use pg_trgm only if it exists
+        if indexes and backend.name == 'postgresql':
+            tools.create_trigram_extension()
+        super().__register__(module_name)
+        if not indexes:
+            return
+        cursor = Transaction().connection.cursor()
+        if backend.name == 'sqlite':
+            # Backfill the fields which have no trigram yet, like the ones
+            # added to a model already filled
+            trigram = Pool().get('widgets.trigram').__table__()
+            cursor.execute(*trigram.select(trigram.field,
+                    where=trigram.model == cls.__name__,
+                    group_by=[trigram.field]))
+            missing = indexes.keys() - {f for f, in cursor}
+            if missing:
+                table = cls.__table__()
+                cursor.execute(*table.select(table.id))
+                cls._update_trigram_index(
+                    [id_ for id_, in cursor], sorted(missing))
+        elif (backend.name == 'postgresql'
+                and 'gist' in indexes.values()
+                and tools.create_trigram_extension()):
+            for name, method in indexes.items():
+                if method != 'gist':
+                    continue
+                cursor.execute(
+                    'CREATE INDEX IF NOT EXISTS "%s" ON "%s" '
+                    'USING %s ("%s" %s_trgm_ops)' % (
+                        '%s_%s_trgm_%s' % (cls._table, name, method),
+                        cls._table, method, name, method))
+
+    @classmethod
+    def _update_trigram_index(cls, ids, names=None):
+        "Store in the trigram table the trigrams of the fields of the records"
+        if names is None:
+            names = list(cls._trigram_fields())
+        if backend.name != 'sqlite' or not names or not ids:
+            return
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        trigram = Pool().get('widgets.trigram').__table__()
+        for sub_ids in grouped_slice(
+                ids, backend.MAX_QUERY_PARAMS - len(names)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*trigram.delete(
+                    where=(trigram.model == cls.__name__)
+                    & trigram.field.in_(names)
+                    & trigram.record.in_(sub_ids)))
+            cursor.execute(*table.select(table.id,
+                    *[Column(table, n) for n in names],
+                    where=table.id.in_(sub_ids)))
+            values = []
+            for row in cursor.fetchall():
+                for name, value in zip(names, row[1:]):
+                    if value is None:
+                        continue
+                    _, trigrams = tools.trigrams(str(value))
+                    values.extend(
+                        [cls.__name__, name, row[0], t] for t in trigrams)
+            values = iter(values)
+            while batch := list(islice(values, 1000)):
+                cursor.execute(*trigram.insert(
+                        [trigram.model, trigram.field, trigram.record,
+                            trigram.trigram],
+                        batch))
+
+    @classmethod
+    def _delete_trigram_index(cls, ids):
+        if backend.name != 'sqlite' or not cls._trigram_fields():
+            return
+        cursor = Transaction().connection.cursor()
+        trigram = Pool().get('widgets.trigram').__table__()
+        for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*trigram.delete(
+                    where=(trigram.model == cls.__name__)
+                    & trigram.record.in_(list(sub_ids))))
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        cls._update_trigram_index([r.id for r in records])
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        names = cls._trigram_fields()
+        ids = set()
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if names.keys() & values.keys():
+                ids.update(r.id for r in records)
+        cls._update_trigram_index(list(ids))
+
+    @classmethod
+    def delete(cls, records):
+        ids = [r.id for r in records]
+        super().delete(records)
+        cls._delete_trigram_index(ids)
+
+    @classmethod
+    def _trigram_candidates(cls, name, value, threshold):
+        '''
+        Returns the query of the ids of the records that share enough trigrams
+        with value to reach threshold using the SQLite trigram table or None
+        '''
+        if name not in cls._trigram_fields():
+            return
+        _, trigrams = tools._trigrams(str(value))
+        if not trigrams:
+            return
+        # similarity = common / (len(a) + len(b) - common) <= common / len(a)
+        minimum = max(1, math.ceil(threshold * len(trigrams) - 1e-9))
+        trigram = Pool().get('widgets.trigram').__table__()
+        return trigram.select(trigram.record,
+            where=(trigram.model == cls.__name__)
+            & (trigram.field == name)
+            & trigram.trigram.in_(list(trigrams)),
+            group_by=[trigram.record],
+            having=Count(Literal('*')) >= minimum)
+
+    @classmethod
+    def best_matches(cls, name, value, limit=10, threshold=None,
+            domain=None):
+        '''
+        Returns the list of (record, similarity) of the limit records which
+        field name is the most similar to value.
+
+        The candidates are filtered using the trigram index, with threshold
+        when set: the pg_trgm similarity operator on PostgreSQL and the
+        widgets_trigram table on SQLite.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        column = Column(table, name)
+        similarity = tools.Similarity(column, value)
+        where = table.id.in_(cls.search(domain or [], query=True))
+        if backend.name == 'postgresql':
+            if threshold is not None:
+                tools.set_similarity_threshold(threshold)
+            where &= tools.TrigramSimilar(column, value)
+            order_by = tools.TrigramDistance(column, value).asc
+        else:
+            tools.create_similarity()
+            if threshold is None:
+                threshold = SIMILARITY_THRESHOLD
+            candidates = cls._trigram_candidates(name, value, threshold)
+            if candidates is not None:
+                where &= table.id.in_(candidates)
+            where &= similarity >= threshold
+            order_by = similarity.desc
+        cursor.execute(*table.select(table.id, similarity,
+                where=where, order_by=[order_by, table.id.asc], limit=limit))
+        return [(cls(id_), score) for id_, score in cursor]
@@ -0,0 +1,255 @@
+# This file is part widgets module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Micro-benchmarks of the widgets tools.
+
+Run with: python -m trytond.modules.widgets.tests.benchmark [name ...]
+'''
+import io
+import json
+import random
+import sqlite3
+import string
+import sys
+import timeit
+
+from trytond.modules.widgets import codec, tools
+
+
+def _document(size):
+    blocks = []
+    for i in range(size):
+        if i % 3 == 0:
+            blocks.append({'id': 'h%s' % i, 'type': 'header',
+                    'data': {'text': 'Header %s' % i, 'level': 2}})
+        elif i % 3 == 1:
+            blocks.append({'id': 'p%s' % i, 'type': 'paragraph',
+                    'data': {'text': 'Paragraph number %s ' % i * 5}})
+        else:
+            blocks.append({'id': 'l%s' % i, 'type': 'list',
+                    'data': {'style': 'unordered',
+                        'items': ['item %s' % j for j in range(5)]}})
+    return json.dumps({'blocks': blocks})
+
+
+def _report(name, size, seconds, unit='block'):
+    print('%-24s %8d %-6s %10.3f ms %10.3f us/%s' % (
+            name, size, unit + 's', seconds * 1000, seconds * 1e6 / size,
+            unit))
+
+
+def _best(func, number=5):
+    return min(timeit.repeat(func, number=1, repeat=number))
+
+
+def bench_js_to_html():
+    "js_to_html must scale linearly with the number of blocks"
+    for size in (1000, 2000, 4000, 8000, 16000):
+        document = _document(size)
+        _report('js_to_html', size, _best(lambda: tools.js_to_html(document)))
+
+
+def bench_js_to_text():
+    "js_to_text must scale linearly with the number of blocks"
+    for size in (1000, 4000, 16000):
+        document = _document(size)
+        _report('js_to_text', size, _best(lambda: tools.js_to_text(document)))
+
+
+def bench_codec():
+    "codec loads and dumps against the standard library"
+    for size in (1000, 16000):
+        document = _document(size)
+        content = json.loads(document)
+        for name, loads, dumps in [
+                ('json', json.loads, json.dumps),
+                ('codec', codec.loads, codec.dumps),
+                ]:
+            _report('%s loads' % name, size,
+                _best(lambda: loads(document)))
+            _report('%s dumps' % name, size,
+                _best(lambda: dumps(content)))
+
+
+def _legacy_has_content(document):
+    return bool(json.loads(document).get('blocks'))
+
+
+def bench_has_content():
+    "has_content without decoding the document"
+    for size in (1000, 16000):
+        document = _document(size)
+        for name, func in [
+                ('legacy', _legacy_has_content),
+                ('codec', tools.has_content),
+                ]:
+            _report('has_content %s' % name, size,
+                _best(lambda: func(document)))
+
+
+def _legacy_js_plus_js(js1, js2):
+    js1 = json.loads(js1)
+    js2 = json.loads(js2)
+    js1['blocks'] += js2['blocks']
+    return json.dumps(js1)
+
+
+def bench_js_plus_js():
+    "js_plus_js splicing the blocks arrays"
+    for size in (1000, 16000):
+        document = _document(size)
+        for name, func in [
+                ('legacy', _legacy_js_plus_js),
+                ('codec', tools.js_plus_js),
+                ]:
+            _report('js_plus_js %s' % name, size * 2,
+                _best(lambda: func(document, document)))
+
+
+def bench_count_blocks():
+    "count_blocks against decoding with the standard library"
+    for size in (1000, 16000):
+        document = _document(size)
+        for name, func in [
+                ('json', lambda d: len(json.loads(d)['blocks'])),
+                ('codec', codec.count_blocks),
+                ]:
+            _report('count_blocks %s' % name, size,
+                _best(lambda: func(document)))
+
+
+def _render_chart(renderer, block, write):
+    "Custom renderer of a smoothed SVG chart"
+    values = block['data']['values']
+    points = []
+    for i in range(1, len(values) - 2):
+        p0, p1, p2, p3 = values[i - 1:i + 3]
+        for step in range(20):
+            t = step / 20
+            y = 0.5 * (2 * p1 + (p2 - p0) * t
+                + (2 * p0 - 5 * p1 + 4 * p2 - p3) * t * t
+                + (3 * p1 - p0 - 3 * p2 + p3) * t * t * t)
+            points.append('%.2f,%.2f' % (i + t, 100 - y))
+    write('<svg viewBox="0 0 %d 100"><path d="M%s"/></svg>' % (
+            len(values), ' L'.join(points)))
+
+
+def bench_incremental():
+    "incremental html render of a 2000 blocks document after a single edit"
+    size = 2000
+    content = json.loads(_document(size))
+    # Charts are memoized, the builtin blocks are rendered every time
+    rng = random.Random(0)
+    for i in range(0, size, 10):
+        content['blocks'][i] = {'id': 'c%s' % i, 'type': 'chart',
+            'data': {'values': [rng.random() * 100 for _ in range(200)]}}
+    tools.HTML_BLOCK_RENDERERS['chart'] = _render_chart
+    tools.MEMOIZED_HTML_BLOCKS.add('chart')
+    try:
+        document = json.dumps(content)
+        tools.incremental_js_to_html(document)
+
+        def edit():
+            content['blocks'][size // 2 + 1]['data']['text'] = str(
+                random.random())
+            return json.dumps(content)
+
+        _report('html full', size, _best(lambda: tools.js_to_html(edit())))
+        _report('html incremental', size,
+            _best(lambda: tools.incremental_js_to_html(edit())))
+    finally:
+        del tools.HTML_BLOCK_RENDERERS['chart']
+        tools.MEMOIZED_HTML_BLOCKS.discard('chart')
+
+
+def _legacy_trigram_similarity(a, b):
+    if a is None or b is None:
+        return None
+    a = str(a).lower()
+    b = str(b).lower()
+    if len(a) < 3 or len(b) < 3:
+        return 1.0 if a == b else 0.0
+
+    def trigrams(s):
+        return {s[i:i + 3] for i in range(len(s) - 2)}
+
+    ta = trigrams(a)
+    tb = trigrams(b)
+    union = ta | tb
+    if not union:
+        return 0.0
+    return len(ta & tb) / len(union)
+
+
+def bench_similarity():
+    "SQLite similarity against a 100k rows table"
+    size = 100000
+    rng = random.Random(0)
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE party (id INTEGER PRIMARY KEY, name TEXT)')
+    conn.executemany('INSERT INTO party (name) VALUES (?)', [
+            (' '.join(''.join(rng.choices(string.ascii_letters, k=8))
+                    for _ in range(3)),)
+            for _ in range(size)])
+    query = ('SELECT id FROM party '
+        'ORDER BY similarity(name, ?) DESC LIMIT 10')
+    for name, func in [
+            ('legacy', _legacy_trigram_similarity),
+            ('memoized', tools.trigram_similarity),
+            ]:
+        conn.create_function('similarity', 2, func)
+        _report('similarity %s' % name, size, _best(
+                lambda: conn.execute(query, ('Jonh Smith',)).fetchall(),
+                number=3), unit='row')
+
+
+def _markdown(kind, size=1024 * 1024):
+    lines = {
+        'paragraph': ['Paragraph with some text %s' % i for i in range(8)],
+        'list': ['- item %s' % i for i in range(8)],
+        'code': ['```'] + ['    code line %s' % i for i in range(6)] + ['```'],
+        'mixed': ['# Header', 'Paragraph', '- item', '1. item', '`code`',
+            '![](widgets/attachment/1)', '---', ''],
+        }[kind]
+    text = '\n'.join(lines) + '\n'
+    return text * (size // len(text) + 1)
+
+
+def bench_text_to_js():
+    "text_to_js throughput on 1 MB inputs"
+    for kind in ('paragraph', 'list', 'code', 'mixed'):
+        text = _markdown(kind)
+        size = len(text) // 1024
+        _report('text_to_js %s' % kind, size,
+            _best(lambda: tools.text_to_js(text), number=3), unit='KB')
+        _report('text_to_js %s stream' % kind, size,
+            _best(lambda: tools.text_to_js(io.StringIO(text)), number=3),
+            unit='KB')
+
+
+def bench_html_to_js_mail():
+    "html_to_js of newsletters with nested layout tables"
+    cell = ('<table><tr><td><p>Paragraph with a <a href="http://x">link</a> '
+        'and <b>bold</b> text</p><img src="http://x/a.png"></td></tr>'
+        '</table>')
+    for size in (1000, 10000, 30000):
+        html = '<html><body>%s</body></html>' % (cell * size)
+        _report('html_to_js mail', size, _best(
+                lambda: tools.html_to_js(html, is_mail=True), number=3),
+            unit='cell')
+
+
+BENCHMARKS = {
+    name[len('bench_'):]: func for name, func in list(globals().items())
+    if name.startswith('bench_')}
+
+
+def main(names=None):
+    for name in names or BENCHMARKS:
+        print('== %s: %s' % (name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,13 +1,110 @@
 # This file is part widgets module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime as dt
+import io
+import json
+import os
+import struct
+import tempfile
+import unittest
+from unittest.mock import patch
+
 from lxml import etree
+from sql import Column, Flavor, Literal, Table
+from werkzeug.http import http_date
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
 
+from trytond import backend
+from trytond.cache import Cache
+from trytond.exceptions import UserError
+from trytond.model import fields
 from trytond.modules.widgets.ir import _WidgetValidator
 from trytond.pool import Pool
 from trytond.tests.test_tryton import ModuleTestCase
 from trytond.tests.test_tryton import with_transaction
-from trytond.modules.widgets import tools
+from trytond.transaction import Transaction
+from trytond.modules.widgets import (
+    codec, encryption, image, routes, similarity, tools, vector)
+
+
+def _search_query(table, domain):
+    "Returns the query of the ids of table matching the domain on id"
+    where = Literal(True)
+    for _, operator, value in domain:
+        where &= table.id.in_(value) if operator == 'in' else (
+            ~table.id.in_(value))
+    return table.select(table.id, where=where)
+
+
+class _Attachment:
+    "Attachment stored in the database"
+    id = 1
+    name = 'file.txt'
+    file_id = None
+    create_date = None
+    write_date = dt.datetime(2026, 1, 1, tzinfo=dt.timezone.utc)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class _Party:
+    "Minimal model on a table of SQLite to test the mixins"
+    __name__ = 'widgets.test.party'
+
+    def __init__(self, id):
+        self.id = id
+
+    @classmethod
+    def __table__(cls):
+        return Table('widgets_test_party')
+
+    @classmethod
+    def create_table(cls):
+        cursor = Transaction().connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS "widgets_test_party"')
+        cursor.execute('CREATE TABLE "widgets_test_party" '
+            '(id INTEGER PRIMARY KEY, name VARCHAR, code VARCHAR)')
+
+    @classmethod
+    def __register__(cls, module_name):
+        pass
+
+    @classmethod
+    def search(cls, domain, query=False):
+        return _search_query(cls.__table__(), domain)
+
+    @classmethod
+    def create(cls, vlist):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        records = []
+        for values in vlist:
+            cursor.execute(*table.insert(
+                    [Column(table, n) for n in values],
+                    [list(values.values())]))
+            records.append(cls(cursor.lastrowid))
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            cursor.execute(*table.update(
+                    [Column(table, n) for n in values],
+                    list(values.values()),
+                    where=table.id.in_([r.id for r in records])))
+
+    @classmethod
+    def delete(cls, records):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        cursor.execute(*table.delete(
+                where=table.id.in_([r.id for r in records])))
 
 
 class WidgetsTestCase(ModuleTestCase):
@@ -36,6 +133,860 @@ class WidgetsTestCase(ModuleTestCase):
         self.assertIn('```\ncode\n```\n\n', markdown_text)
         self.assertIn('![](widgets/attachment/1)\n\n', markdown_text)
 
+    def test_text_to_js(self):
+        "Test text_to_js"
+        text = ('# HEADER\n\nParagraph\n- one\n- two\n1. first\n2. second\n'
+            '```\ncode\n  indented\n```\n---\n')
+        blocks = [
+            {'type': 'header', 'data': {'level': 1, 'text': 'HEADER'}},
+            {'type': 'paragraph', 'data': {'text': 'Paragraph'}},
+            {'type': 'list', 'data': {
+                    'style': 'unordered', 'items': [' one', ' two']}},
+            {'type': 'list', 'data': {
+                    'style': 'ordered', 'items': [' first', ' second']}},
+            {'type': 'code', 'data': {'code': 'code\n  indented'}},
+            {'type': 'delimeter', 'data': {}},
+            ]
+
+        self.assertEqual(json.loads(tools.text_to_js(text)),
+            {'blocks': blocks})
+        self.assertEqual(tools.text_to_js(io.StringIO(text)),
+            tools.text_to_js(text))
+
+    def test_html_to_js_mail(self):
+        "Test html_to_js of mails"
+        html = ('<html><head><style>p {}</style></head><body>Hello <b>you</b>'
+            '<h2>Title</h2><p>Text <a href="javascript:x">link</a><br></p>'
+            '<table><tr><th>A</th></tr><tr><td>1</td></tr></table>'
+            '<ul><li>one</li></ul><script>alert()</script>end</body></html>')
+        blocks = [
+            {'type': 'paragraph', 'data': {'text': 'Hello <b>you</b>'}},
+            {'type': 'header', 'data': {'text': 'Title', 'level': 2}},
+            {'type': 'paragraph', 'data': {'text': 'Text <a>link</a><br>'}},
+            {'type': 'table', 'data': {
+                    'withHeadings': True, 'content': [['A'], ['1']]}},
+            {'type': 'list', 'data': {
+                    'style': 'unordered', 'items': ['one']}},
+            {'type': 'paragraph', 'data': {'text': 'end'}},
+            ]
+
+        self.assertEqual(json.loads(tools.html_to_js(html, is_mail=True)),
+            {'blocks': blocks})
+        self.assertEqual(
+            list(tools.iter_html_blocks(io.StringIO(html))), blocks)
+        self.assertEqual(tools.html_to_js('', is_mail=True), '')
+        self.assertEqual(
+            list(tools.iter_html_blocks('<p>%s</p>' % ('x' * 100), 10)),
+            [{'type': 'paragraph', 'data': {'text': 'xxxxxxx'}}])
+
+        deep = ('<p>before</p>' + '<div>' * 300 + 'deep' + '</div>' * 300
+            + '<p>after</p>')
+        self.assertEqual(list(tools.iter_html_blocks(deep)), [
+                {'type': 'paragraph', 'data': {'text': 'before'}},
+                {'type': 'paragraph', 'data': {'text': 'deep'}},
+                {'type': 'paragraph', 'data': {'text': 'after'}},
+                ])
+
+        self.assertEqual(list(tools.iter_html_blocks(
+                    '<p>Logo <img src="cid:logo" alt="Logo"> here</p>')), [
+                {'type': 'paragraph', 'data': {'text': 'Logo'}},
+                {'type': 'image', 'data': {
+                        'file': {'url': 'cid:logo'}, 'caption': 'Logo'}},
+                {'type': 'paragraph', 'data': {'text': 'here'}},
+                ])
+
+        self.assertEqual(list(tools.iter_html_blocks(
+                    '<ol><li>a<ul><li>nested</li></ul></li>'
+                    '<li><p>b</p><p>c</p></li></ol>')), [
+                {'type': 'list', 'data': {
+                        'style': 'ordered',
+                        'items': ['a', 'nested', 'b<br>c']}},
+                ])
+
+        self.assertEqual(list(tools.iter_html_blocks(
+                    '<p>café</p>'.encode('utf-8'), encoding='utf-8')),
+            [{'type': 'paragraph', 'data': {'text': 'café'}}])
+
+    def test_codec(self):
+        "Test codec block operations"
+        empty = '{"time": 1, "blocks": [ ], "version": "2.31"}'
+        paragraph = ('{"blocks":[{"type":"paragraph",'
+            '"data":{"text":"a ] \\"b\\""}}],"version":"2.31"}')
+        nested = '{"meta": {"blocks": []}, "blocks": [{"type": "delimeter"}]}'
+
+        for document, count in [
+                (None, 0), ('', 0), (empty, 0), (paragraph, 1), (nested, 1)]:
+            with self.subTest(document=document):
+                self.assertEqual(codec.count_blocks(document), count)
+                self.assertEqual(tools.has_content(document), bool(count))
+        for document1 in [empty, paragraph, nested]:
+            for document2 in [empty, paragraph, nested]:
+                with self.subTest(document1=document1, document2=document2):
+                    content = json.loads(document1)
+                    content['blocks'] += json.loads(document2)['blocks']
+                    self.assertEqual(json.loads(
+                            tools.js_plus_js(document1, document2)), content)
+        self.assertTrue(codec.is_document(nested))
+        self.assertFalse(codec.is_document('{"blocks" is text}'))
+
+    def test_trigram_similarity(self):
+        "Test trigram similarity"
+        for a, b, result in [
+                ('Tryton', 'tryton', 1.0),
+                ('abcd', 'bcde', 1 / 3),
+                ('ab', 'AB', 1.0),
+                ('ab', 'abc', 0.0),
+                (None, 'abc', None),
+                (12345, '12345', 1.0),
+                ]:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(tools.trigram_similarity(a, b), result)
+
+    def test_trigram_operators(self):
+        "Test trigram operators"
+        table = Table('party')
+        flavor = Flavor.get()
+        try:
+            for paramstyle, param, percent in [
+                    ('format', '%s', '%%'), ('qmark', '?', '%')]:
+                Flavor.set(Flavor(paramstyle=paramstyle))
+                for operator, sql in [
+                        (tools.TrigramSimilar, '"name" %s {}' % percent),
+                        (tools.TrigramWordSimilar,
+                            '"name" <%s {}' % percent),
+                        (tools.TrigramDistance, '"name" <-> {}'),
+                        (tools.Similarity, 'SIMILARITY("name", {})'),
+                        ]:
+                    with self.subTest(
+                            paramstyle=paramstyle, operator=operator):
+                        expression = operator(table.name, 'tryton')
+                        self.assertEqual(str(expression), sql.format(param))
+                        self.assertEqual(expression.params, ('tryton',))
+        finally:
+            Flavor.set(flavor)
+
+    @unittest.skipIf(backend.name != 'sqlite', "SQLite similarity")
+    @with_transaction()
+    def test_best_matches(self):
+        "Test best matches"
+        class Party(similarity.SimilarityMixin, _Party):
+            _fields = {'name': fields.Char("Name")}
+
+        Party.create_table()
+        Party.create([{'name': n}
+                for n in ['Tryton', 'Trytond', 'Python', None]])
+
+        def best_matches(*args, **kwargs):
+            return [(r.id, s) for r, s in
+                Party.best_matches('name', *args, **kwargs)]
+
+        self.assertEqual(best_matches('tryton'), [(1, 1.0), (2, 0.8)])
+        self.assertEqual(best_matches('tryton', limit=1), [(1, 1.0)])
+        self.assertEqual(best_matches('tryton', threshold=0.9), [(1, 1.0)])
+        self.assertEqual(
+            best_matches('tryton', domain=[('id', 'not in', [1])]),
+            [(2, 0.8)])
+        self.assertEqual(best_matches('python', threshold=0), [
+                (3, 1.0), (1, 0.0), (2, 0.0)])
+
+    @unittest.skipIf(backend.name != 'sqlite', "SQLite trigram table")
+    @with_transaction()
+    def test_trigram_table(self):
+        "Test trigram table synchronization and candidates"
+        Trigram = Pool().get('widgets.trigram')
+
+        class Party(similarity.SimilarityMixin, _Party):
+            _fields = {
+                'name': similarity.trigram_index(fields.Char("Name")),
+                'code': fields.Char("Code"),
+                }
+
+        def indexed(party):
+            return {t.trigram for t in Trigram.search([
+                        ('model', '=', Party.__name__),
+                        ('field', '=', 'name'),
+                        ('record', '=', party.id),
+                        ])}
+
+        def candidates(value, threshold):
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*Party._trigram_candidates(
+                    'name', value, threshold))
+            return {r for r, in cursor}
+
+        Party.create_table()
+        tryton, trytex, short = Party.create([
+                {'name': 'Tryton'}, {'name': 'Trytex'}, {'name': 'ab'}])
+        self.assertEqual(indexed(tryton), {'try', 'ryt', 'yto', 'ton'})
+        self.assertEqual(indexed(short), set())
+
+        # Tryton shares 4 trigrams and Trytex 2 out of 4
+        self.assertEqual(candidates('tryton', 0.5), {tryton.id, trytex.id})
+        self.assertEqual(candidates('tryton', 0.6), {tryton.id})
+        self.assertEqual(candidates('trytond', 1), set())
+        self.assertIsNone(Party._trigram_candidates('name', 'ab', 0.3))
+        self.assertIsNone(Party._trigram_candidates('code', 'tryton', 0.3))
+
+        Party.write([trytex], {'name': 'Python'})
+        self.assertEqual(indexed(trytex), {'pyt', 'yth', 'tho', 'hon'})
+        Party.write([trytex], {'name': None})
+        self.assertEqual(indexed(trytex), set())
+
+        Party.delete([tryton])
+        self.assertEqual(indexed(tryton), set())
+        self.assertEqual(candidates('tryton', 0.5), set())
+
+    @unittest.skipIf(backend.name != 'sqlite', "SQLite trigram table")
+    @with_transaction()
+    def test_trigram_table_backfill(self):
+        "Test trigram table backfill of the new fields"
+        Trigram = Pool().get('widgets.trigram')
+
+        class Party(similarity.SimilarityMixin, _Party):
+            _fields = {
+                'name': similarity.trigram_index(fields.Char("Name")),
+                'code': fields.Char("Code"),
+                }
+
+        def trigrams(field):
+            return Trigram.search([
+                    ('model', '=', Party.__name__),
+                    ('field', '=', field),
+                    ], order=[('id', 'ASC')])
+
+        Party.create_table()
+        Party.create([{'name': 'Tryton', 'code': 'TRY'}])
+        Party.__register__('widgets')
+        names = trigrams('name')
+        self.assertEqual(len(names), 4)
+        self.assertEqual(trigrams('code'), [])
+
+        Party._fields['code'] = similarity.trigram_index(fields.Char("Code"))
+        Party.__register__('widgets')
+        self.assertEqual(
+            {t.trigram for t in trigrams('code')}, {'try'})
+        # The trigrams of the indexed fields are kept
+        self.assertEqual(trigrams('name'), names)
+
+    def test_js_to_html(self):
+        "Test js_to_html"
+        value = json.dumps({'blocks': [
+                    {'type': 'header', 'data': {'text': 'HEADER', 'level': 2}},
+                    {'type': 'paragraph', 'data': {'text': 'Paragraph'}},
+                    {'type': 'list', 'data': {
+                            'style': 'ordered', 'items': ['one', 'two']}},
+                    {'type': 'delimeter', 'data': {}},
+                    ]})
+        html = ('<html><body><h2>HEADER</h2><br /><p>Paragraph</p>'
+            '<ol><li>one</li><li>two</li></ol><br /><hr /><br />'
+            '</body></html>')
+
+        self.assertEqual(tools.js_to_html(value), html)
+        self.assertEqual(
+            ''.join(tools.iter_js_to_html(value, chunk_size=1)), html)
+        self.assertEqual(tools.js_to_html(''), '')
+        self.assertIsNone(tools.js_to_html('invalid'))
+
+    def test_js_to_html_custom_renderer(self):
+        "Test js_to_html with a custom block renderer"
+        def render_embed(renderer, block, write):
+            write('<iframe src="%s"></iframe>' % block['data']['embed'])
+
+        renderers = tools.HTML_BLOCK_RENDERERS.copy()
+        renderers['embed'] = render_embed
+        renderer = tools.HTMLRenderer(renderers=renderers)
+
+        self.assertEqual(
+            renderer.render([{'type': 'embed', 'data': {'embed': 'url'}}]),
+            '<html><body><iframe src="url"></iframe></body></html>')
+
+    def test_render_many(self):
+        "Test render_many"
+        value = json.dumps({'blocks': [
+                    {'type': 'paragraph', 'data': {'text': 'Paragraph'}}]})
+        records = [(1, value), (2, None), (3, 'invalid'), (4, value)]
+
+        self.assertEqual(list(tools.render_many(records, batch_size=3)), [
+                (1, tools.js_to_html(value)),
+                (2, ''),
+                (3, None),
+                (4, tools.js_to_html(value)),
+                ])
+        self.assertEqual(list(tools.render_many(records, format='text')), [
+                (1, 'Paragraph\n\n'), (2, ''), (3, ''), (4, 'Paragraph\n\n')])
+
+    def test_render_cache(self):
+        "Test render cache"
+        cache = tools.RenderCache(size_limit=2)
+        values = [json.dumps({'blocks': [
+                        {'type': 'paragraph', 'data': {'text': str(i)}}]})
+            for i in range(3)]
+
+        for value in values + values[-1:]:
+            self.assertEqual(tools.cached_js_to_html(value, cache=cache),
+                tools.js_to_html(value))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        self.assertIsNone(
+            cache.get(cache.key('html', values[0], '', None, False)))
+
+        key = cache.key('html', values[1], '', None, False)
+        cache.set(key, 'html', attachment_ids=[1])
+        cache.invalidate_attachments([1])
+        self.assertIsNone(cache.get(key))
+
+    @with_transaction()
+    def test_render_cache_cluster(self):
+        "Test render cache on trytond caches"
+        cache = tools.RenderCache(
+            cache=Cache('widgets.test.render', context=False),
+            attachment_cache=Cache(
+                'widgets.test.render.attachment', context=False))
+        key1 = cache.key('html', 'content1', '', None, False)
+        key2 = cache.key('html', 'content2', '', None, False)
+        cache.set(key1, 'html1')
+        cache.set(key2, 'html2', attachment_ids=[1])
+        self.assertEqual(cache.get_many([key1, key2]), ['html1', 'html2'])
+
+        cache.invalidate_attachments([1])
+        self.assertEqual(cache.get_many([key1, key2]), ['html1', None])
+
+    def test_incremental_render(self):
+        "Test incremental render"
+        rendered = []
+
+        def render_chart(renderer, block, write):
+            rendered.append(block['id'])
+            write('<svg>%s</svg>' % block['data']['values'])
+
+        cache = tools.RenderCache()
+        blocks = [
+            {'id': '0', 'type': 'chart', 'data': {'values': [0]}},
+            {'id': '1', 'type': 'chart', 'data': {'values': [1]}},
+            {'id': '2', 'type': 'paragraph', 'data': {'text': 'text'}},
+            ]
+        value = json.dumps({'blocks': blocks})
+
+        with patch.dict(tools.HTML_BLOCK_RENDERERS, chart=render_chart), \
+                patch.object(tools, 'MEMOIZED_HTML_BLOCKS',
+                    tools.MEMOIZED_HTML_BLOCKS | {'chart'}):
+            self.assertEqual(tools.incremental_js_to_html(value, cache=cache),
+                tools.js_to_html(value))
+            blocks[1]['data']['values'] = [2]
+            blocks[2]['data']['text'] = 'changed'
+            changed = json.dumps({'blocks': blocks})
+            rendered.clear()
+            html = tools.incremental_js_to_html(changed, cache=cache)
+            self.assertEqual(rendered, ['1'])
+            self.assertEqual(html, tools.js_to_html(changed))
+        # The paragraphs are not memoized
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        self.assertEqual(tools.incremental_js_to_html(''), '')
+        self.assertIsNone(tools.incremental_js_to_html('invalid'))
+
+    @with_transaction()
+    def test_js_to_html_images(self):
+        "Test js_to_html resolves image attachments"
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Lang = pool.get('ir.lang')
+
+        lang, = Lang.search([('code', '=', 'en')])
+        attachment, = Attachment.create([{
+                    'name': 'image.png',
+                    'resource': str(lang),
+                    'data': b'image',
+                    }])
+        url = 'widgets/attachment/%s' % attachment.id
+        value = json.dumps({'blocks': [
+                    {'type': 'image', 'data': {'file': {'url': url}}},
+                    {'type': 'image', 'data': {'file': {'url': url}}},
+                    {'type': 'image', 'data': {'file': {
+                                'url': 'widgets/attachment/0'}}},
+                    ]})
+
+        self.assertEqual(tools.image_sources([url], '/static/'),
+            {url: '/static/image.png'})
+        self.assertEqual(tools.image_sources(
+                [url, 'widgets/attachment/0', '/image.png'], '/static/', 200),
+            {url: '/static/image.png',
+                'widgets/attachment/0': 'widgets/attachment/0?w=200',
+                '/image.png': '/image.png'})
+        self.assertEqual(tools.image_sources([url], 'base64'),
+            {url: 'data:;base64,aW1hZ2U='})
+        self.assertEqual(tools.js_to_html(value, 'cid:').count(
+                'cid:' + tools.cid_from_attachment(attachment)), 2)
+
+        html, parts = tools.js_to_email(value)
+        cid = tools.cid_from_attachment(attachment)
+        self.assertEqual(html, tools.js_to_html(value, 'cid:'))
+        self.assertEqual(parts, [(cid, 'image/png', b'image')])
+        html, parts = tools.js_to_email(value, width=200)
+        self.assertEqual(html, tools.js_to_html(value, 'cid:', width=200))
+        self.assertIn('width="200"', html)
+        self.assertEqual(parts, [(cid, 'image/png', b'image')])
+        html, parts = tools.js_to_email(
+            value, max_inline_size=1, url_prefix='/static/')
+        self.assertIn('<img src="/static/image.png" />', html)
+        self.assertEqual(parts, [])
+        html, parts = tools.js_to_email(value, max_inline_size=1)
+        self.assertIn('<img src="%s" />' % url, html)
+        self.assertEqual(parts, [])
+        html, parts = tools.js_to_email(
+            value, width=200, resize=True, max_inline_size=1)
+        self.assertIn('<img src="%s?w=200" width="200"/>' % url, html)
+
+    @unittest.skipIf(image.Image is None, "Pillow is not installed")
+    def test_resize_image(self):
+        "Test resize image"
+        data = io.BytesIO()
+        image.Image.new('RGB', (800, 400)).save(data, format='JPEG')
+        data = data.getvalue()
+
+        resized, mimetype = image.resize_image(data, 200)
+        self.assertEqual(mimetype, 'image/jpeg')
+        self.assertEqual(
+            image.Image.open(io.BytesIO(resized)).size, (200, 100))
+        self.assertIsNone(image.resize_image(data, 1000))
+        self.assertIsNone(image.resize_image(b'not an image', 200))
+
+    @unittest.skipIf(image.Image is None, "Pillow is not installed")
+    def test_image_variant(self):
+        "Test image variant"
+        reads = []
+
+        class Attachment(_Attachment):
+            file_id = None
+
+            @property
+            def data(self):
+                reads.append(self.name)
+                return self._data
+
+            def __init__(self, name, data, file_id):
+                self.name = name
+                self._data = data
+                self.file_id = file_id
+
+        def png(width):
+            data = io.BytesIO()
+            image.Image.new('RGB', (width, 100)).save(data, format='PNG')
+            return data.getvalue()
+
+        with tempfile.TemporaryDirectory() as path, \
+                patch.object(image, 'VARIANT_PATH', path):
+            document = Attachment('file.pdf', png(800), 'pdf')
+            self.assertIsNone(image.get_variant(document, 200))
+            self.assertEqual(reads, [])
+
+            large = Attachment('large.png', png(800), 'large')
+            small = Attachment('small.png', png(100), 'small')
+            for _ in range(2):
+                data, mimetype = image.get_variant(large, 200)
+                self.assertEqual(mimetype, 'image/png')
+                self.assertEqual(
+                    image.Image.open(io.BytesIO(data)).size, (320, 40))
+                self.assertIsNone(image.get_variant(small, 200))
+            # The variant and the not resizable image are cached
+            self.assertEqual(reads, ['large.png', 'small.png'])
+
+    def test_attachment_ranges(self):
+        "Test attachment byte ranges"
+        attachment = _Attachment(b'0123456789')
+        etag = 'etag'
+
+        def response(**headers):
+            request = Request(EnvironBuilder(headers=headers).get_environ())
+            response = routes._stream_response(
+                request, attachment, etag, attachment.write_date)
+            return response, b''.join(response.response)
+
+        response_, data = response()
+        self.assertEqual(response_.status_code, 200)
+        self.assertEqual(data, b'0123456789')
+        self.assertEqual(response_.content_length, 10)
+        self.assertEqual(response_.accept_ranges, 'bytes')
+
+        for range_, content, content_range in [
+                ('bytes=2-5', b'2345', 'bytes 2-5/10'),
+                ('bytes=8-', b'89', 'bytes 8-9/10'),
+                ('bytes=-3', b'789', 'bytes 7-9/10'),
+                ('bytes=-20', b'0123456789', 'bytes 0-9/10'),
+                ('bytes=5-20', b'56789', 'bytes 5-9/10'),
+                ]:
+            with self.subTest(range=range_):
+                response_, data = response(Range=range_)
+                self.assertEqual(response_.status_code, 206)
+                self.assertEqual(data, content)
+                self.assertEqual(
+                    response_.headers['Content-Range'], content_range)
+                self.assertEqual(response_.content_length, len(content))
+
+        response_, data = response(Range='bytes=0-1,5-6')
+        self.assertEqual(response_.status_code, 206)
+        self.assertEqual(response_.mimetype, 'multipart/byteranges')
+        boundary = response_.mimetype_params['boundary'].encode('ascii')
+        self.assertEqual(data, (
+                b'\r\n--%(b)s\r\nContent-Type: text/plain\r\n'
+                b'Content-Range: bytes 0-1/10\r\n\r\n01'
+                b'\r\n--%(b)s\r\nContent-Type: text/plain\r\n'
+                b'Content-Range: bytes 5-6/10\r\n\r\n56'
+                b'\r\n--%(b)s--\r\n') % {b'b': boundary})
+        self.assertEqual(response_.content_length, len(data))
+
+        response_, data = response(Range='bytes=20-30')
+        self.assertEqual(response_.status_code, 416)
+        self.assertEqual(response_.headers['Content-Range'], 'bytes */10')
+        self.assertEqual(data, b'')
+
+        for if_range in ['"other"', http_date(dt.datetime(2000, 1, 1))]:
+            with self.subTest(if_range=if_range):
+                response_, data = response(
+                    Range='bytes=2-5', **{'If-Range': if_range})
+                self.assertEqual(response_.status_code, 200)
+                self.assertEqual(data, b'0123456789')
+        for if_range in ['"etag"', http_date(attachment.write_date)]:
+            with self.subTest(if_range=if_range):
+                response_, data = response(
+                    Range='bytes=2-5', **{'If-Range': if_range})
+                self.assertEqual(response_.status_code, 206)
+                self.assertEqual(data, b'2345')
+
+    @with_transaction()
+    def test_attachment_filestore(self):
+        "Test attachment streamed from the filestore"
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Lang = pool.get('ir.lang')
+
+        lang, = Lang.search([('code', '=', 'en')])
+        attachment, = Attachment.create([{
+                    'name': 'file.txt',
+                    'resource': str(lang),
+                    'data': b'0123456789',
+                    }])
+        if not attachment.file_id:
+            self.skipTest("Attachments are not stored in the filestore")
+        attachment = Attachment(attachment.id)
+        request = Request(EnvironBuilder(
+                headers={'Range': 'bytes=2-5'}).get_environ())
+
+        with patch.object(routes.filestore, 'get',
+                    side_effect=AssertionError("data read")), \
+                patch.object(routes.filestore, 'getmany',
+                    side_effect=AssertionError("data read")):
+            file, size = routes._open_attachment(attachment)
+            file.close()
+            self.assertEqual(size, 10)
+            response = routes._stream_response(
+                request, attachment, 'etag', None)
+            self.assertEqual(b''.join(response.response), b'2345')
+
+    def test_attachment_not_modified(self):
+        "Test attachment not modified"
+        last_modified = dt.datetime(2026, 1, 1, tzinfo=dt.timezone.utc)
+
+        def not_modified(**headers):
+            request = Request(EnvironBuilder(headers=headers).get_environ())
+            return routes._is_not_modified(request, 'etag', last_modified)
+
+        self.assertFalse(not_modified())
+        self.assertTrue(not_modified(**{'If-None-Match': '"etag"'}))
+        self.assertTrue(not_modified(**{'If-None-Match': '"other", "etag"'}))
+        self.assertTrue(not_modified(**{'If-None-Match': 'W/"etag"'}))
+        self.assertTrue(not_modified(**{'If-None-Match': '*'}))
+        self.assertFalse(not_modified(**{'If-None-Match': '"other"'}))
+        self.assertTrue(not_modified(
+                **{'If-Modified-Since': http_date(last_modified)}))
+        self.assertTrue(not_modified(**{'If-Modified-Since': http_date(
+                        last_modified + dt.timedelta(days=1))}))
+        self.assertFalse(not_modified(**{'If-Modified-Since': http_date(
+                        last_modified - dt.timedelta(seconds=1))}))
+        # The entity tags have precedence over the dates
+        self.assertFalse(not_modified(**{
+                    'If-None-Match': '"other"',
+                    'If-Modified-Since': http_date(last_modified),
+                    }))
+
+    def test_variant_width(self):
+        "Test image variant width"
+        for width, result in [
+                (1, image.VARIANT_WIDTHS[0]),
+                (image.VARIANT_WIDTHS[1], image.VARIANT_WIDTHS[1]),
+                (image.VARIANT_WIDTHS[1] + 1, image.VARIANT_WIDTHS[2]),
+                (image.MAX_WIDTH * 2, image.MAX_WIDTH),
+                ]:
+            with self.subTest(width=width):
+                self.assertEqual(image.variant_width(width), result)
+
+    def test_variant_eviction(self):
+        "Test image variant eviction"
+        with tempfile.TemporaryDirectory() as path, \
+                patch.object(image, 'VARIANT_PATH', path), \
+                patch.object(image, 'VARIANT_SIZE_LIMIT', 100), \
+                patch.object(image, '_size', None), \
+                patch.object(image, '_evict', wraps=image._evict) as evict:
+            for i in range(3):
+                with open(os.path.join(path, str(i)), 'wb') as file:
+                    file.write(b'x' * 40)
+                os.utime(file.name, (i, i))
+
+            image._add_size(40)
+            self.assertEqual(sorted(os.listdir(path)), ['1', '2'])
+            self.assertEqual(image._size, 80)
+            image._add_size(10)
+            self.assertEqual(evict.call_count, 1)
+
+    @with_transaction()
+    def test_migration_checkpoint(self):
+        "Test migration checkpoint"
+        Checkpoint = Pool().get('widgets.migration.checkpoint')
+
+        self.assertEqual(Checkpoint.get_last_id('table', 'column'), 0)
+        Checkpoint.set_last_id('table', 'column', 10)
+        Checkpoint.set_last_id('table', 'column', 20)
+        self.assertEqual(Checkpoint.get_last_id('table', 'column'), 20)
+        Checkpoint.set_last_id('table', 'column', None)
+        self.assertEqual(Checkpoint.get_last_id('table', 'column'), 0)
+
+    @with_transaction()
+    def test_migrate_field(self):
+        "Test migrate field in batches from the checkpoint"
+        Checkpoint = Pool().get('widgets.migration.checkpoint')
+        cursor = Transaction().connection.cursor()
+        table = Table('widgets_test_migration')
+        cursor.execute('DROP TABLE IF EXISTS "widgets_test_migration"')
+        cursor.execute('CREATE TABLE "widgets_test_migration" '
+            '(id INTEGER PRIMARY KEY, body VARCHAR)')
+        document = tools.text_to_js('converted')
+        cursor.execute(*table.insert([table.id, table.body], [
+                    [1, 'before checkpoint'], [2, document], [3, 'three'],
+                    [4, None], [5, 'five'], [6, 'six']]))
+        Checkpoint.set_last_id(table._name, 'body', 1)
+
+        updates, checkpoints = [], []
+        bulk_update, set_last_id = tools.bulk_update, Checkpoint.set_last_id
+
+        def record_update(sql_table, field, values):
+            updates.append([id_ for id_, _ in values])
+            bulk_update(sql_table, field, values)
+
+        def record_checkpoint(table_name, column_name, last_id):
+            checkpoints.append(last_id)
+            set_last_id(table_name, column_name, last_id)
+
+        with patch.object(tools, 'bulk_update', record_update), \
+                patch.object(Checkpoint, 'set_last_id', record_checkpoint):
+            tools.migrate_field(table, table.body, 'text', batch_size=2)
+
+        # The converted document is skipped and the null is not read
+        self.assertEqual(updates, [[3], [5, 6]])
+        self.assertEqual(checkpoints, [3, 6, None])
+        cursor.execute(*table.select(table.id, table.body,
+                order_by=table.id.asc))
+        self.assertEqual(dict(cursor), {
+                1: 'before checkpoint',
+                2: document,
+                3: tools.text_to_js('three'),
+                4: None,
+                5: tools.text_to_js('five'),
+                6: tools.text_to_js('six'),
+                })
+        self.assertEqual(Checkpoint.get_last_id(table._name, 'body'), 0)
+        # migrate_field commits so the cleanup must be committed too
+        cursor.execute('DROP TABLE "widgets_test_migration"')
+        Transaction().connection.commit()
+
+    def test_rotate_tokens(self):
+        "Test rotate Fernet tokens"
+        new, old = keys = (
+            encryption.Fernet.generate_key(),
+            encryption.Fernet.generate_key())
+        tokens = [
+            (1, encryption.Fernet(old).encrypt(b'old')),
+            (2, encryption.Fernet(new).encrypt(b'new')),
+            ]
+
+        (id_, token), = encryption.rotate_tokens(tokens, keys)
+        self.assertEqual(id_, 1)
+        self.assertEqual(encryption.Fernet(new).decrypt(token), b'old')
+        self.assertEqual(
+            encryption._fernet(keys).decrypt(tokens[0][1]), b'old')
+
+    def test_blind_index(self):
+        "Test blind index values"
+        class Party(encryption.FernetEncryptionMixin):
+            _fields = {'vat_blind': None, 'vat_blind_prefix': None}
+
+        with patch.object(encryption, 'BLIND_INDEX_KEY', 'key'):
+            values = Party._blind_index_values('vat', 'be 0123 456')
+            self.assertEqual(values, {
+                    'vat_blind': Party._blind_hash('BE0123456'),
+                    'vat_blind_prefix': Party._blind_hash('BE01'),
+                    })
+            self.assertEqual(Party.search_fernet_value(
+                    'vat_decrypted', ('vat_decrypted', 'in', ['BE0123456'])),
+                [('vat_blind', 'in', [values['vat_blind']])])
+            self.assertEqual(Party._blind_index_values('vat', 'BE'),
+                {'vat_blind': Party._blind_hash('BE'),
+                    'vat_blind_prefix': None})
+            self.assertEqual(Party._blind_index_values('vat', None),
+                {'vat_blind': None, 'vat_blind_prefix': None})
+
+    def test_fernet_values(self):
+        "Test decrypt Fernet values"
+        key = encryption.Fernet.generate_key()
+        fernet = encryption.Fernet(key)
+
+        class Party(encryption.FernetEncryptionMixin):
+            _fields = {
+                'vat': fields.Char("VAT"),
+                'vat_encrypted': fields.Binary("VAT Encrypted"),
+                }
+            rows = [
+                {'id': 1, 'vat_encrypted': fernet.encrypt(b'BE0123')},
+                {'id': 2, 'vat_encrypted': None},
+                {'id': 3, 'vat_encrypted': fernet.encrypt(b'FR4567')},
+                ]
+
+            def __init__(self, id):
+                self.id = id
+                self.vat_encrypted = self.rows[id - 1]['vat_encrypted']
+
+            @classmethod
+            def read(cls, ids, names):
+                return [r for r in cls.rows if r['id'] in ids]
+
+        parties = [Party(i) for i in [1, 2, 3]]
+        expected = {
+            'vat': {1: 'x' * 10, 2: 'x' * 10, 3: 'x' * 10},
+            'vat_decrypted': {1: 'BE0123', 2: None, 3: 'FR4567'},
+            }
+        with patch.object(encryption, 'FERNET_KEYS', (key,)):
+            for threads, thread_min in [(0, 1000), (2, 2)]:
+                with self.subTest(threads=threads), \
+                        patch.object(encryption, 'FERNET_THREADS', threads), \
+                        patch.object(
+                            encryption, 'FERNET_THREAD_MIN', thread_min), \
+                        patch.object(encryption, 'ThreadPoolExecutor',
+                            wraps=encryption.ThreadPoolExecutor) as executor:
+                    self.assertEqual(Party.get_fernet_values(
+                            parties, ['vat', 'vat_decrypted']), expected)
+                    self.assertEqual(executor.called, bool(threads))
+            self.assertEqual(
+                parties[0].get_fernet_value('vat_decrypted'), 'BE0123')
+            self.assertIsNone(parties[1].get_fernet_value('vat_decrypted'))
+            self.assertEqual(parties[0].get_fernet_value('vat'), 'x' * 10)
+
+            Party.rows[2]['vat_encrypted'] = b'invalid'
+            with self.assertRaises(UserError):
+                Party.get_fernet_values(parties, ['vat_decrypted'])
+
+    @with_transaction()
+    def test_vector_get(self):
+        "Test vector BLOB round trip"
+        blob = vector._to_blob([1.0, 2.5, -3.0])
+        self.assertEqual(blob, struct.pack('<3f', 1.0, 2.5, -3.0))
+
+        field = vector.Vector('Embedding', size=3)
+        self.assertEqual(field.get([1, 2], None, 'embedding', [
+                    {'id': 1, 'embedding': blob},
+                    {'id': 2, 'embedding': None},
+                    ]), {1: [1.0, 2.5, -3.0], 2: None})
+        self.assertEqual(field.get([1], None, 'embedding', [
+                    {'id': 1, 'embedding': '[1, 2.5, -3]'},
+                    ]), {1: [1.0, 2.5, -3.0]})
+
+    @unittest.skipIf(vector.np is None, "numpy is not installed")
+    @with_transaction()
+    def test_vector_get_numpy(self):
+        "Test vector get as numpy array"
+        field = vector.Vector('Embedding', size=3, numpy=True)
+        value = field.get([1], None, 'embedding', [
+                {'id': 1, 'embedding': vector._to_blob([1.0, 2.5, -3.0])},
+                ])[1]
+        self.assertIsInstance(value, vector.np.ndarray)
+        self.assertEqual(value.dtype, vector.np.float32)
+        self.assertEqual(value.tolist(), [1.0, 2.5, -3.0])
+
+    @unittest.skipIf(vector.np is None, "numpy is not installed")
+    @unittest.skipIf(backend.name != 'sqlite', "BLOB vectors of SQLite")
+    @with_transaction()
+    def test_vector_nearest_brute_force(self):
+        "Test vector nearest brute force"
+        table = Table('widgets_test_vector')
+
+        class Document(vector.VectorSearchMixin):
+            _fields = {'embedding': vector.Vector('Embedding', size=2)}
+
+            def __init__(self, id):
+                self.id = id
+
+            @classmethod
+            def __table__(cls):
+                return Table('widgets_test_vector')
+
+            @classmethod
+            def search(cls, domain, query=False):
+                return _search_query(table, domain)
+
+        cursor = Transaction().connection.cursor()
+        cursor.execute('CREATE TABLE "widgets_test_vector" '
+            '(id INTEGER PRIMARY KEY, embedding BLOB)')
+        cursor.executemany(
+            'INSERT INTO "widgets_test_vector" (id, embedding) VALUES (?, ?)',
+            [(1, vector._to_blob([0, 0])), (2, vector._to_blob([1, 0])),
+                (3, vector._to_blob([0, 3])), (4, None),
+                (5, vector._to_blob([-2, 0]))])
+
+        def nearest(*args, **kwargs):
+            return [(r.id, round(d, 3)) for r, d in
+                Document._nearest_brute_force('embedding', *args, **kwargs)]
+
+        self.assertEqual(nearest([0.9, 0], 2, 'l2', None, batch_size=2),
+            [(2, 0.1), (1, 0.9)])
+        self.assertEqual(nearest([0.9, 0], 2, 'l2', [('id', 'not in', [2])]),
+            [(1, 0.9), (5, 2.9)])
+        self.assertEqual(nearest([0, 1], 1, 'cosine', None), [(3, 0.0)])
+        self.assertEqual(nearest([1, 1], 1, 'inner_product', None),
+            [(3, -3.0)])
+
+        vector.create_vector_functions()
+        cursor.execute('SELECT vector_l2_distance(embedding, ?) '
+            'FROM "widgets_test_vector" WHERE id = 3',
+            (vector._to_blob([0, 0]),))
+        self.assertEqual(cursor.fetchone()[0], 3.0)
+
+    def test_vector_copy_binary(self):
+        "Test vector binary COPY data"
+        header = b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8
+        trailer = b'\xff\xff'
+
+        self.assertEqual(
+            vector._copy_binary([(1, [1.0, -2.0])], 'vector').read(),
+            header
+            # 2 columns, 4 bytes integer id
+            + b'\x00\x02' + b'\x00\x00\x00\x04' + b'\x00\x00\x00\x01'
+            # 12 bytes vector of dimension 2 and 2 float4
+            + b'\x00\x00\x00\x0c' + b'\x00\x02' + b'\x00\x00'
+            + b'\x3f\x80\x00\x00' + b'\xc0\x00\x00\x00'
+            + trailer)
+        self.assertEqual(
+            vector._copy_binary([(2, [1.0]), (3, [])], 'halfvec').read(),
+            header
+            + b'\x00\x02' + b'\x00\x00\x00\x04' + b'\x00\x00\x00\x02'
+            # 6 bytes halfvec of dimension 1 and 1 float2
+            + b'\x00\x00\x00\x06' + b'\x00\x01' + b'\x00\x00' + b'\x3c\x00'
+            + b'\x00\x02' + b'\x00\x00\x00\x04' + b'\x00\x00\x00\x03'
+            + b'\x00\x00\x00\x04' + b'\x00\x00' + b'\x00\x00'
+            + trailer)
+
+    @unittest.skipIf(vector.np is not None, "numpy is installed")
+    @with_transaction()
+    def test_vector_without_numpy(self):
+        "Test vector search without numpy"
+        with self.assertRaises(UserError):
+            vector.read_array(None, [], 'embedding')
+
     @with_transaction()
     def test_validator_supports_custom_widgets(self):
         "Test validator supports custom widgets"
@@ -49,6 +1000,28 @@ class WidgetsTestCase(ModuleTestCase):
             with self.subTest(xml=xml):
                 validator.assertValid(etree.fromstring(xml))
 
+        # The archs are not serialized to be remembered by default
+        with patch.object(etree, 'tostring') as tostring:
+            validator.assertValid(etree.fromstring(xml))
+        tostring.assert_not_called()
+        self.assertFalse(validator._valid)
+
+    @with_transaction()
+    def test_validator_prepare_tree(self):
+        "Test validator only copies trees with custom widgets"
+        View = Pool().get('ir.ui.view')
+        validator = View._validator('form')
+
+        tree = etree.fromstring('<form><field name="body"/></form>')
+        self.assertIs(validator._prepare_tree(tree), tree)
+
+        tree = etree.fromstring(
+            '<form><field name="body" widget="code" language="json"/></form>')
+        prepared = validator._prepare_tree(tree)
+        self.assertEqual(etree.tostring(prepared),
+            b'<form><field name="body" widget="text"/></form>')
+        self.assertEqual(tree[0].get('widget'), 'code')
+
     @with_transaction()
     def test_validator_is_not_rewrapped(self):
         "Test validator wrapper is cached once"
@@ -1,13 +1,31 @@
 import base64
 import hashlib
-import json
+import logging
+import mimetypes
 import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from email.message import EmailMessage
+from functools import lru_cache, partial
+from html import escape as html_escape
+from itertools import islice
 from html2text import html2text
+from lxml import etree
+from sql import Column, Flavor, Literal, Null, Values
+from sql.aggregate import Count
 from sql.functions import Function
+from sql.operators import BinaryOperator
+import trytond.config as config
 from trytond import backend
+from trytond.cache import Cache
 from trytond.pool import Pool
 from trytond.transaction import Transaction
-from bs4 import BeautifulSoup
+
+from . import codec, image
+
+logger = logging.getLogger(__name__)
 
 
 class Similarity(Function):
@@ -15,262 +33,1179 @@ class Similarity(Function):
     _function = 'SIMILARITY'
 
 
+class TrigramSimilar(BinaryOperator):
+    '''
+    pg_trgm similarity operator (%) which can use a trigram index
+    '''
+    __slots__ = ()
+
+    @property
+    def _operator(self):
+        # '%' must be escaped with format paramstyle
+        if Flavor.get().paramstyle == 'format':
+            return '%%'
+        return '%'
+
+
+class TrigramWordSimilar(BinaryOperator):
+    '''
+    pg_trgm word similarity operator (<%) which can use a trigram index
+    '''
+    __slots__ = ()
+
+    @property
+    def _operator(self):
+        if Flavor.get().paramstyle == 'format':
+            return '<%%'
+        return '<%'
+
+
+class TrigramDistance(BinaryOperator):
+    '''
+    pg_trgm distance operator (<->) which can use a GiST trigram index to
+    order by
+    '''
+    __slots__ = ()
+    _operator = '<->'
+
+
+def set_similarity_threshold(threshold, word=False):
+    '''
+    Sets the pg_trgm threshold of the similarity operators for the current
+    transaction
+    '''
+    if backend.name != 'postgresql':
+        return
+    cursor = Transaction().connection.cursor()
+    name = ('pg_trgm.word_similarity_threshold' if word
+        else 'pg_trgm.similarity_threshold')
+    cursor.execute('SELECT set_config(%s, %s, true)', (name, str(threshold)))
+
+
+def create_trigram_extension():
+    '''
+    Returns if the pg_trgm extension is available, it is created when the
+    widgets.create_pg_trgm option is set
+    '''
+    if backend.name != 'postgresql':
+        return False
+    cursor = Transaction().connection.cursor()
+    cursor.execute(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    if cursor.fetchone():
+        return True
+    if config.getboolean('widgets', 'create_pg_trgm', default=False):
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        return True
+    logger.warning('pg_trgm extension is not installed')
+    return False
+
+
+def trigrams(value):
+    '''
+    Returns the lowered value when it is shorter than a trigram and the set of
+    its trigrams
+    '''
+    value = value.lower()
+    if len(value) < 3:
+        return value, frozenset()
+    return None, frozenset([value[i:i + 3] for i in range(len(value) - 2)])
+
+
+# The compared values are often the same, unlike the indexed ones which
+# would only evict them
+_trigrams = lru_cache(maxsize=config.getint(
+        'widgets', 'similarity_cache_size', default=10000))(trigrams)
+
+
+def trigram_similarity(a, b):
+    if a is None or b is None:
+        return None
+    short_a, ta = _trigrams(a if a.__class__ is str else str(a))
+    short_b, tb = _trigrams(b if b.__class__ is str else str(b))
+    if short_a is not None or short_b is not None:
+        return 1.0 if short_a == short_b else 0.0
+    common = len(ta & tb)
+    return common / (len(ta) + len(tb) - common)
+
+
 def create_similarity():
     conn = Transaction().connection
     if backend.name == 'sqlite':
-        def trigram_similarity(a, b):
-            if a is None or b is None:
-                return None
-            a = str(a).lower()
-            b = str(b).lower()
-            if len(a) < 3 or len(b) < 3:
-                return 1.0 if a == b else 0.0
-
-            def trigrams(s):
-                return {s[i:i + 3] for i in range(len(s) - 2)}
-
-            ta = trigrams(a)
-            tb = trigrams(b)
-            union = ta | tb
-            if not union:
-                return 0.0
-            return len(ta & tb) / len(union)
         conn.create_function('similarity', 2, trigram_similarity)
 
 
 def js_plus_js(js1, js2):
-    if not js1:
-        return js2
-    if not js2:
-        return js1
-    js1 = json.loads(js1)
-    js2 = json.loads(js2)
-    js1['blocks'] += js2['blocks']
-    return json.dumps(js1)
+    return codec.concat_blocks(js1, js2)
+
+HTML_BLOCK_RENDERERS = {}
+# Block types memoized by incremental_js_to_html
+MEMOIZED_HTML_BLOCKS = {'image'}
+
+
+def html_block_renderer(*types, memoize=False):
+    '''
+    Registers the decorated function as the HTML renderer of the given
+    editorJS block types.
+
+    The function is called with the HTMLRenderer, the block and the write
+    callable of the output buffer. If memoize is set, the fragments of the
+    blocks are kept by incremental_js_to_html which is only worth it when
+    the rendering is more expensive than serializing the block.
+    '''
+    def decorator(func):
+        for type_ in types:
+            HTML_BLOCK_RENDERERS[type_] = func
+            if memoize:
+                MEMOIZED_HTML_BLOCKS.add(type_)
+            else:
+                MEMOIZED_HTML_BLOCKS.discard(type_)
+        return func
+    return decorator
+
+
+class HTMLRenderer:
+    '''
+    Renders editorJS blocks into html writing every fragment into a single
+    buffer using the handlers registered with html_block_renderer
+    '''
+    def __init__(self, url_prefix='', width=None, renderers=None,
+            sources=None, resize=False):
+        self.url_prefix = url_prefix
+        self.width = width
+        self.resize = resize
+        if renderers is None:
+            renderers = HTML_BLOCK_RENDERERS
+        self.renderers = renderers
+        # Image sources resolved beforehand with image_sources
+        self.sources = sources or {}
+
+    def render_block(self, block, write):
+        renderer = self.renderers.get(block['type'], _render_html_unknown)
+        renderer(self, block, write)
+
+    def render(self, blocks):
+        buffer = []
+        write = buffer.append
+        write('<html><body>')
+        for block in blocks:
+            self.render_block(block, write)
+        write('</body></html>')
+        return ''.join(buffer)
+
+    def iter_render(self, blocks, chunk_size=100):
+        '''
+        Yields the html document in chunks of chunk_size blocks
+        '''
+        buffer = []
+        write = buffer.append
+        write('<html><body>')
+        for i, block in enumerate(blocks, 1):
+            self.render_block(block, write)
+            if not i % chunk_size:
+                yield ''.join(buffer)
+                buffer.clear()
+        write('</body></html>')
+        yield ''.join(buffer)
+
+    def image_source(self, url):
+        if url not in self.sources:
+            self.sources.update(image_sources([url], self.url_prefix,
+                    self.width if self.resize else None))
+        return self.sources[url]
+
+
+def _render_html_unknown(renderer, block, write):
+    write('<br />')
+
+
+@html_block_renderer('list')
+def _render_html_list(renderer, block, write):
+    tag = 'ul' if block['data']['style'] == 'unordered' else 'ol'
+    write('<' + tag + '>')
+    for entry in block['data']['items']:
+        write('<li>' + entry + '</li>')
+    write('</' + tag + '><br />')
+
+
+@html_block_renderer('header')
+def _render_html_header(renderer, block, write):
+    level = str(block['data']['level'])
+    write('<h' + level + '>' + block['data']['text'] + '</h' + level
+        + '><br />')
+
+
+@html_block_renderer('paragraph')
+def _render_html_paragraph(renderer, block, write):
+    write('<p>' + block['data']['text'] + '</p>')
+
+
+@html_block_renderer('checklist')
+def _render_html_checklist(renderer, block, write):
+    write('<form>')
+    for counter, entry in enumerate(block['data']['items']):
+        is_checked = "true" if entry['checked'] else "false"
+        write('<input type="checkbox" id="checkbox' + str(counter)
+            + '" value="checkbox' + str(counter) + '" checked="'
+            + is_checked + '" />')
+        write('<label for="checkbox' + str(counter) + '">' + entry['text']
+            + '</label>')
+    write('</form><br />')
+
+
+@html_block_renderer('table')
+def _render_html_table(renderer, block, write):
+    write('<table>')
+    counter = 0
+    for entry in block['data']['content']:
+        write('<tr>')
+        for text in entry:
+            if block['data']['withHeadings'] == True and counter == 0:
+                write('<th>' + text + '</th>')
+            else:
+                write('<td>' + text + '</td>')
+        write('</tr>')
+    write('</table><br />')
+
+
+@html_block_renderer('delimeter')
+def _render_html_delimeter(renderer, block, write):
+    write('<hr /><br />')
+
 
-def js_to_html(content_block, url_prefix='', width=None):
+@html_block_renderer('warning')
+def _render_html_warning(renderer, block, write):
+    write('<table><tr><th>' + block['data']['title'] + '</th></tr>')
+    write('<tr><td>' + block['data']['message'] + '</td></tr><br />')
+
+
+@html_block_renderer('code')
+def _render_html_code(renderer, block, write):
+    write('<code>')
+    try:
+        write(re.sub('[^\\]\\n', '<br />', block['data']['code']))
+    except re.error:
+        pass
+    write('</code><br />')
+
+
+@html_block_renderer('quote')
+def _render_html_quote(renderer, block, write):
+    write('<blockquote cite=' + block['data']['caption'] + '>'
+        + block['data']['text'] + '</blockquote><br />')
+
+
+@html_block_renderer('image')
+def _render_html_image(renderer, block, write):
+    src = renderer.image_source(block['data']['file']['url'])
+    if renderer.width:
+        img_width = f'width="{renderer.width}"'
+    else:
+        img_width = ''
+    if src:
+        write(f'<img src="{src}" {img_width}/>')
+    write('<br />')
+
+
+@html_block_renderer('link')
+def _render_html_link(renderer, block, write):
+    write('<a href=' + block['data']['url'] + '></a><br />')
+
+
+def _load_blocks(content_block):
+    try:
+        return codec.loads(content_block)['blocks']
+    except (codec.JSONDecodeError, TypeError):
+        return
+
+
+def js_to_html(content_block, url_prefix='', width=None, resize=False):
     '''
     Converts editorJS data blocks into an html document
+
+    When resize is set, the images are downscaled to width on the server
+    instead of only setting the width attribute.
     '''
     if not content_block:
         return ''
 
-    try:
-        js_object = json.loads(content_block)
-    except (json.JSONDecodeError, TypeError):
+    blocks = _load_blocks(content_block)
+    if blocks is None:
         return
+    sources = image_sources(image_urls(blocks), url_prefix,
+        width if resize else None)
+    return _render_html(blocks, url_prefix=url_prefix, width=width,
+        sources=sources, resize=resize)
 
-    html = '<html><body>'
-    for block in js_object['blocks']:
-        was_p = False
-        match block['type']:
-            case 'list':
-                if block['data']['style'] == 'unordered':
-                    html += '<ul>'
-                    for entry in block['data']['items']:
-                        html += '<li>' + entry + '</li>'
-                    html += '</ul>'
-                else:
-                    html += '<ol>'
-                    for entry in block['data']['items']:
-                        html += '<li>' + entry + '</li>'
-                    html += '</ol>'
-            case 'header':
-                html += '<h' + str(block['data']['level']) + '>' + block['data']['text'] + '</h' + str(block['data']['level']) + '>'
-            case 'paragraph':
-                html += '<p>' + block['data']['text'] + '</p>'
-                was_p = True
-            case 'checklist':
-                html += '<form>'
-                counter = 0
-                for entry in block['data']['items']:
-                    is_checked = "false"
-                    if entry['checked']:
-                        is_checked = "true"
-                    html += '<input type="checkbox" id="checkbox' + str(counter) + '" value="checkbox' + str(counter) + '" checked="' + is_checked + '" />'
-                    html += '<label for="checkbox' + str(counter) + '">'+ entry['text'] + '</label>'
-                    counter += 1
-                html += '</form>'
-            case 'table':
-                html += '<table>'
-                counter = 0
-                for entry in block['data']['content']:
-                    html += '<tr>'
-                    for text in entry:
-                        if block['data']['withHeadings'] == True and counter == 0:
-                            html += '<th>' + text + '</th>'
-                        else:
-                            html += '<td>' + text + '</td>'
-                    html += '</tr>'
-                html += '</table>'
-            case 'delimeter':
-                html += '<hr />'
-            case 'warning':
-                html += '<table><tr><th>' + block['data']['title'] + '</th></tr>'
-                html += '<tr><td>' + block['data']['message'] + '</td></tr>'
-            case 'code':
-                html += '<code>'
-                try:
-                    html += re.sub('[^\\]\\n', '<br />', block['data']['code'])
-                except re.error:
-                    pass
-                html += '</code>'
-            case 'quote':
-                html += '<blockquote cite=' + block['data']['caption'] + '>' + block['data']['text'] + '</blockquote>'
-            case 'image':
-                src = None
-                url = block['data']['file']['url']
-                if url_prefix == 'cid:':
-                    attachment = attachment_from_url(url)
-                    if attachment:
-                        src = 'cid:' + cid_from_attachment(attachment)
-                elif url_prefix == 'base64':
-                    attachment = attachment_from_url(url)
-                    if attachment:
-                        src = 'data:;base64,' + base64.b64encode(attachment.data).decode('utf-8')
+def _render_html(blocks, url_prefix='', width=None, sources=None,
+        resize=False):
+    return HTMLRenderer(url_prefix=url_prefix, width=width,
+        sources=sources, resize=resize).render(blocks)
+
+def iter_js_to_html(content_block, url_prefix='', width=None,
+        chunk_size=100, resize=False):
+    '''
+    Converts editorJS data blocks into an html document yielding it in chunks
+    so it can be streamed to a file or a WSGI response
+    '''
+    if not content_block:
+        return
+
+    blocks = _load_blocks(content_block)
+    if blocks is None:
+        return
+    sources = image_sources(image_urls(blocks), url_prefix,
+        width if resize else None)
+    renderer = HTMLRenderer(url_prefix=url_prefix, width=width,
+        sources=sources, resize=resize)
+    yield from renderer.iter_render(blocks, chunk_size=chunk_size)
+
+def write_js_to_html(content_block, file, url_prefix='', width=None,
+        chunk_size=100, resize=False):
+    '''
+    Writes the html document of the editorJS data blocks into file
+    '''
+    for chunk in iter_js_to_html(content_block, url_prefix=url_prefix,
+            width=width, chunk_size=chunk_size, resize=resize):
+        file.write(chunk)
+
+def render_many(records, format='html', url_prefix='', width=None,
+        batch_size=1000, max_workers=None, resize=False):
+    '''
+    Converts the editorJS content of many records yielding (id, result)
+    pairs in the same order as the (id, content) pairs of records.
+
+    format is 'html' (js_to_html) or 'text' (js_to_text). Records are
+    processed in batches of batch_size so memory stays bounded and the image
+    attachments of a batch are resolved at once. When max_workers is set, the
+    conversion runs in a pool of processes.
+    '''
+    if format not in {'html', 'text'}:
+        raise ValueError('Unknown format: %s' % format)
+    records = iter(records)
+    executor = None
+    if max_workers:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            if format == 'text':
+                results = [None] * len(batch)
+                pending = list(enumerate(content for _, content in batch))
+                func = js_to_text
+            else:
+                results = ['' if not c else None for _, c in batch]
+                pending = []
+                urls = set()
+                for i, (_, content) in enumerate(batch):
+                    if not content:
+                        continue
+                    blocks = _load_blocks(content)
+                    if blocks is None:
+                        continue
+                    urls.update(image_urls(blocks))
+                    pending.append((i, blocks))
+                sources = image_sources(urls, url_prefix,
+                    width if resize else None)
+                func = partial(_render_html, url_prefix=url_prefix,
+                    width=width, sources=sources, resize=resize)
+            values = [v for _, v in pending]
+            if executor:
+                chunksize = max(1, len(values) // (max_workers * 4))
+                converted = executor.map(func, values, chunksize=chunksize)
+            else:
+                converted = map(func, values)
+            for (i, _), result in zip(pending, converted):
+                results[i] = result
+            for (id_, _), result in zip(batch, results):
+                yield id_, result
+    finally:
+        if executor:
+            executor.shutdown()
+
+def js_to_email(content_block, width=None, resize=False,
+        max_inline_size=None, url_prefix=''):
+    '''
+    Converts editorJS data blocks into an html document for an email and
+    returns it with the list of (cid, mimetype, data) inline parts of its
+    images.
+
+    Every attachment is loaded once and included once whatever the number
+    of blocks referencing it. Once the inline parts reach max_inline_size
+    bytes, the remaining images are referenced with url_prefix like in
+    js_to_html or with the attachment route when url_prefix is empty.
+    '''
+    if not content_block:
+        return '', []
+    blocks = _load_blocks(content_block)
+    if blocks is None:
+        return None, []
+
+    pool = Pool()
+    Attachment = pool.get('ir.attachment')
+    variant_width = width if resize else None
+    urls = set(image_urls(blocks))
+    attachments = attachments_from_urls(urls)
+    data = {}
+    if attachments:
+        data = {a['id']: a['data']
+            for a in Attachment.read(list(attachments), ['data'])}
+
+    sources, parts, cids = {}, [], {}
+    inline_size = 0
+    for url in image_urls(blocks):
+        if url in sources:
+            continue
+        id_ = attachment_id_from_url(url)
+        attachment = attachments.get(id_)
+        if id_ is None:
+            sources[url] = url
+            continue
+        elif not attachment:
+            sources[url] = None
+            continue
+        if attachment.id not in cids:
+            content = data[attachment.id] or b''
+            variant = image.get_variant(attachment, variant_width, content)
+            if variant:
+                content, mimetype = variant
+            else:
+                mimetype = (mimetypes.guess_type(attachment.name)[0]
+                    or 'application/octet-stream')
+            if (max_inline_size is not None
+                    and inline_size + len(content) > max_inline_size):
+                cids[attachment.id] = None
+            else:
+                inline_size += len(content)
+                cid = cid_from_attachment(attachment, variant_width)
+                cids[attachment.id] = cid
+                parts.append((cid, mimetype, content))
+        if cids[attachment.id]:
+            sources[url] = 'cid:' + cids[attachment.id]
+        elif url_prefix:
+            sources[url] = url_prefix + attachment.name
+        elif variant_width:
+            sources[url] = url + '?w=%s' % variant_width
+        else:
+            sources[url] = url
+
+    html = _render_html(blocks, url_prefix='cid:', width=width,
+        sources=sources, resize=resize)
+    return html, parts
+
+def js_to_email_message(content_block, width=None, resize=False,
+        max_inline_size=None, url_prefix='', text=None):
+    '''
+    Returns an EmailMessage with the text and the html alternatives of the
+    editorJS data blocks and the images as related inline parts
+    '''
+    html, parts = js_to_email(content_block, width=width, resize=resize,
+        max_inline_size=max_inline_size, url_prefix=url_prefix)
+    if text is None:
+        text = js_to_text(content_block)
+    msg = EmailMessage()
+    msg.set_content(text)
+    if html:
+        msg.add_alternative(html, subtype='html')
+        html_part = msg.get_payload()[-1]
+        for cid, mimetype, data in parts:
+            maintype, subtype = mimetype.split('/', 1)
+            html_part.add_related(data, maintype=maintype, subtype=subtype,
+                cid='<%s>' % cid, disposition='inline')
+    return msg
+
+class RenderCache:
+    '''
+    LRU cache of rendered editorJS content keyed by the hash of the content
+    and the render arguments, bounded by number of entries and total size.
+
+    When cache is a trytond Cache, entries are stored on it instead so they
+    are invalidated on all the processes of the cluster. As a trytond Cache
+    can only be cleared as a whole, the entries rendered with attachments are
+    stored on attachment_cache when it is set so updating an attachment
+    clears only them instead of all the entries.
+    '''
+    def __init__(self, size_limit=1024, bytes_limit=64 * 1024 * 1024,
+            cache=None, attachment_cache=None):
+        self.size_limit = size_limit
+        self.bytes_limit = bytes_limit
+        self.hits = 0
+        self.misses = 0
+        self._cache = cache
+        self._attachment_cache = attachment_cache
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._attachment_keys = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def key(self, format, content, *args):
+        return self.keys(format, [content], *args)[0]
+
+    def keys(self, format, contents, *args):
+        "Returns the keys of the str or bytes contents"
+        database = getattr(Transaction(), 'database', None)
+        prefix = (database.name if database else None, format)
+        sha256 = hashlib.sha256
+        return [prefix + (sha256(
+                    c.encode('utf-8') if isinstance(c, str) else c
+                    ).hexdigest(),) + args
+            for c in contents]
+
+    def get(self, key, default=None):
+        with self._lock:
+            if self._cache is not None:
+                value = self._cache.get(key, _MISSING)
+                if (value is _MISSING
+                        and self._attachment_cache is not None):
+                    value = self._attachment_cache.get(key, _MISSING)
+            elif key in self._entries:
+                self._entries.move_to_end(key)
+                value, _ = self._entries[key]
+            else:
+                value = _MISSING
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def get_many(self, keys, default=None):
+        "Returns the list of the values of keys"
+        if self._cache is not None:
+            return [self.get(k, default) for k in keys]
+        values = []
+        with self._lock:
+            entries = self._entries
+            for key in keys:
+                entry = entries.get(key)
+                if entry is None:
+                    values.append(default)
                 else:
-                    src = url_from_tryton_to_flask(url, url_prefix)
-                if width:
-                    img_width = f'width="{width}"'
+                    entries.move_to_end(key)
+                    values.append(entry[0])
+            misses = values.count(default)
+            self.hits += len(values) - misses
+            self.misses += misses
+        return values
+
+    def set(self, key, value, attachment_ids=None):
+        '''
+        Stores value under key, attachment_ids are the ids of the attachments
+        used to render it
+        '''
+        with self._lock:
+            if self._cache is not None:
+                if attachment_ids and self._attachment_cache is not None:
+                    self._attachment_cache.set(key, value)
                 else:
-                    img_width = ''
-                if src:
-                    html += f'<img src="{src}" {img_width}/>'
-            case 'link':
-                html += '<a href=' + block['data']['url'] + '></a>'
-        if not was_p:
-            html += '<br />'
-
-    html += '</body></html>'
+                    self._cache.set(key, value)
+                return
+            size = len(value)
+            if size > self.bytes_limit:
+                return
+            self._discard(key)
+            attachment_ids = frozenset(attachment_ids or [])
+            self._entries[key] = (value, attachment_ids)
+            self._bytes += size
+            for attachment_id in attachment_ids:
+                self._attachment_keys[attachment_id].add(key)
+            while (len(self._entries) > self.size_limit
+                    or self._bytes > self.bytes_limit):
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        if key not in self._entries:
+            return
+        value, attachment_ids = self._entries.pop(key)
+        self._bytes -= len(value)
+        for attachment_id in attachment_ids:
+            keys = self._attachment_keys[attachment_id]
+            keys.discard(key)
+            if not keys:
+                del self._attachment_keys[attachment_id]
+
+    def invalidate_attachments(self, ids):
+        '''
+        Removes the entries rendered with any of the attachments
+        '''
+        with self._lock:
+            if self._attachment_cache is not None:
+                self._attachment_cache.clear()
+                return
+            elif self._cache is not None:
+                self._cache.clear()
+                return
+            for attachment_id in ids:
+                for key in list(self._attachment_keys.get(attachment_id, [])):
+                    self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            if self._cache is not None:
+                self._cache.clear()
+            if self._attachment_cache is not None:
+                self._attachment_cache.clear()
+            self._entries.clear()
+            self._attachment_keys.clear()
+            self._bytes = 0
+
+
+_MISSING = object()
+
+if config.getboolean('widgets', 'render_cache_cluster', default=False):
+    _render_cache_backend = Cache('widgets.render', context=False)
+    _render_attachment_cache_backend = Cache(
+        'widgets.render.attachment', context=False)
+else:
+    _render_cache_backend = _render_attachment_cache_backend = None
+render_cache = RenderCache(
+    size_limit=config.getint('widgets', 'render_cache_size', default=1024),
+    bytes_limit=config.getint(
+        'widgets', 'render_cache_bytes', default=64 * 1024 * 1024),
+    cache=_render_cache_backend,
+    attachment_cache=_render_attachment_cache_backend)
+# Fragments of the blocks memoized by incremental_js_to_html
+block_cache = RenderCache(
+    size_limit=config.getint('widgets', 'block_cache_size', default=10000),
+    bytes_limit=config.getint(
+        'widgets', 'block_cache_bytes', default=64 * 1024 * 1024))
+
+
+def cached_js_to_html(content_block, url_prefix='', width=None,
+        resize=False, cache=None):
+    '''
+    Same as js_to_html but memoized in cache (render_cache by default)
+    '''
+    if cache is None:
+        cache = render_cache
+    if not content_block or not isinstance(content_block, str):
+        return js_to_html(content_block, url_prefix=url_prefix, width=width,
+            resize=resize)
+
+    key = cache.key('html', content_block, url_prefix, width, resize)
+    html = cache.get(key, _MISSING)
+    if html is _MISSING:
+        blocks = _load_blocks(content_block)
+        if blocks is None:
+            return
+        urls = image_urls(blocks)
+        html = _render_html(blocks, url_prefix=url_prefix, width=width,
+            sources=image_sources(urls, url_prefix,
+                width if resize else None),
+            resize=resize)
+        attachment_ids = {attachment_id_from_url(url) for url in urls}
+        attachment_ids.discard(None)
+        cache.set(key, html, attachment_ids)
     return html
 
-def js_to_text(js):
-    text = ''
-    try:
-        js_object = json.loads(js)
-    except TypeError:
-        return text
-    except json.decoder.JSONDecodeError:
-        return text
+def cached_js_to_text(js, cache=None):
+    '''
+    Same as js_to_text but memoized in cache (render_cache by default)
+    '''
+    if cache is None:
+        cache = render_cache
+    if not js or not isinstance(js, str):
+        return js_to_text(js)
+
+    key = cache.key('text', js)
+    text = cache.get(key, _MISSING)
+    if text is _MISSING:
+        text = js_to_text(js)
+        cache.set(key, text)
+    return text
+
+def _cached_blocks(cache, format, blocks, args, render, memoize):
+    '''
+    Returns the fragments of the blocks rendering the missing ones with render
+    called with their list of (index, block). Only the blocks for which
+    memoize is true are kept in cache, the others are rendered every time.
+    '''
+    fragments = [_MISSING] * len(blocks)
+    memoized = [i for i, block in enumerate(blocks) if memoize(block)]
+    keys = dict(zip(memoized, cache.keys(
+                format, [codec.dumpb(blocks[i]) for i in memoized], *args)))
+    for i, fragment in zip(memoized, cache.get_many(keys.values(), _MISSING)):
+        fragments[i] = fragment
+    missing = [(i, blocks[i]) for i, fragment in enumerate(fragments)
+        if fragment is _MISSING]
+    if missing:
+        for (i, block), fragment in zip(missing, render(missing)):
+            if i in keys:
+                attachment_ids = {attachment_id_from_url(url)
+                    for url in image_urls([block])}
+                attachment_ids.discard(None)
+                cache.set(keys[i], fragment, attachment_ids)
+            fragments[i] = fragment
+    return fragments
+
+def incremental_js_to_html(content_block, url_prefix='', width=None,
+        resize=False, cache=None):
+    '''
+    Same as js_to_html but the html of the blocks of MEMOIZED_HTML_BLOCKS
+    types is memoized in cache (block_cache by default) so they are rendered
+    again only when they are changed.
+
+    The other blocks are cheaper to render than to key so they are always
+    rendered. The blocks are keyed by the hash of their content, including
+    their id, and the render arguments.
+    '''
+    if cache is None:
+        cache = block_cache
+    if not content_block:
+        return ''
+    blocks = _load_blocks(content_block)
+    if blocks is None:
+        return
+
+    def memoize(block):
+        return block.get('type') in MEMOIZED_HTML_BLOCKS
+
+    def render(missing):
+        sources = image_sources(image_urls([b for _, b in missing]),
+            url_prefix, width if resize else None)
+        renderer = HTMLRenderer(url_prefix=url_prefix, width=width,
+            sources=sources, resize=resize)
+        for _, block in missing:
+            buffer = []
+            renderer.render_block(block, buffer.append)
+            yield ''.join(buffer)
+
+    fragments = _cached_blocks(cache, 'html-block', blocks,
+        (url_prefix, width, resize), render, memoize)
+    return '<html><body>' + ''.join(fragments) + '</body></html>'
+
+
+_BR = re.compile(r'<br\s*/?>', re.IGNORECASE)
 
-    def _replace_br(value):
-        return re.sub(r'<br\s*/?>', r'\n\n', value, flags=re.IGNORECASE)
 
+def _replace_br(value):
+    return _BR.sub('\n\n', value)
+
+
+def _render_text_block(block):
+    type_ = block.get('type', 'paragraph')
+    if type_ == 'header':
+        return '# %s\n\n' % _replace_br(block['data']['text'])
+    elif type_ == 'list':
+        return ''.join('- %s\n' % _replace_br(item)
+            for item in block['data']['items']) + '\n'
+    elif type_ == 'quote':
+        return '> %s\n\n' % _replace_br(block['data']['text'])
+    elif type_ == 'code':
+        return '```\n%s\n```\n\n' % block['data']['code']
+    elif type_ == 'image':
+        if block['data'].get('url'):
+            return '![](%s)\n\n' % block['data']['url']
+        elif block['data'].get('file'):
+            return '![](%s)\n\n' % block['data']['file']['url']
+    elif type_ == 'checklist':
+        return ''.join('[%s] %s\n' % (
+                    'X' if item['checked'] else '', _replace_br(item['text']))
+            for item in block['data']['items']) + '\n'
+    elif block['data'].get('text'):
+        return '%s\n\n' % _replace_br(block['data']['text'])
+    return ''
+
+
+def _load_text_blocks(js):
     try:
-        blocks = js_object['blocks']
+        js_object = codec.loads(js)
     except TypeError:
-        return text
+        return
+    except codec.JSONDecodeError:
+        return
+    try:
+        return js_object['blocks']
+    except TypeError:
+        return
+
+
+def js_to_text(js):
+    blocks = _load_text_blocks(js)
+    if blocks is None:
+        return ''
+    return ''.join(map(_render_text_block, blocks))
+
+
+_MD_IMAGE_ALT = re.compile(r'!\[[^\]]*\]')
+_MD_ORDERED = re.compile(r'\d+\.')
+_MD_IMAGE_LINK = ('[image', '[!]')
+
+
+def _md_image_url(line):
+    if line[0] == '!':
+        line = _MD_IMAGE_ALT.sub('', line)
+        return line.strip('[').split(':')[-1].strip(']').strip()
+    elif line[0] == '<':
+        return line.strip('<').split(':')[-1].strip('>').strip()
+    else:
+        return line.replace('[!]', '').strip('(').strip(')')
+
+
+def _md_lines(text):
+    if isinstance(text, str):
+        return text.split('\n')
+    return (line.rstrip('\n') for line in text)
+
+
+def _lex_markdown(lines):
+    '''
+    Yields the (kind, data) tokens of the Markdown-like lines where kind is
+    'block' for a complete block or the marker of a list item
+    '''
+    fence = None
+    for line in lines:
+        if fence is not None:
+            if line.strip().startswith('```'):
+                yield 'block', {'data': {'code': '\n'.join(fence)},
+                    'type': 'code'}
+                fence = None
+            else:
+                fence.append(line.rstrip('\r'))
+            continue
+        line = line.replace('\\', '').strip()
+        if not line:
+            yield 'blank', None
+            continue
+        line = line.replace('[![]', '[!]')
+        first = line[0]
+        if first == '#':
+            yield 'block', {'data': {
+                    'level': len(line.split(' ', 1)[0]),
+                    'text': line.strip('#').strip(' '),
+                    }, 'type': 'header'}
+        elif first == '-':
+            if line == '--':
+                yield 'block', {'data': {'text': line}, 'type': 'paragraph'}
+            elif len(line) > 2:
+                if line[1] == '-' and line[2] == '-':
+                    yield 'block', {'data': {}, 'type': 'delimeter'}
+                else:
+                    yield '-', line.strip('-')
+            else:
+                yield 'blank', None
+        elif first == '>':
+            if len(line) > 1:
+                yield '>', line.strip('>')
+            else:
+                yield 'blank', None
+        elif first == '`':
+            if line.startswith('```') and (
+                    len(line) == 3 or not line.endswith('```')):
+                fence = []
+            else:
+                yield 'block', {'data': {'code': line.strip('`')},
+                    'type': 'code'}
+        elif first in '!<[':
+            if (first == '!' or line.startswith('<image>')
+                    or line.startswith(_MD_IMAGE_LINK)):
+                yield 'block', {'data': {'url': _md_image_url(line)},
+                    'type': 'image'}
+            else:
+                yield 'blank', None
+        elif first.isdigit() and (match := _MD_ORDERED.match(line)):
+            yield '1.', line[match.end():]
+        else:
+            yield 'block', {'data': {'text': line}, 'type': 'paragraph'}
+    if fence is not None:
+        yield 'block', {'data': {'code': '\n'.join(fence)}, 'type': 'code'}
 
-    for block in blocks:
-        type_ = block.get('type', 'paragraph')
-        if type_ == 'header':
-            text += '# %s\n\n' % _replace_br(block['data']['text'])
-        elif type_ == 'list':
-            for item in  block['data']['items']:
-                text += '- %s\n' % _replace_br(item)
-            text += '\n'
-        elif type_ == 'quote':
-            text += '> %s\n\n' % _replace_br(block['data']['text'])
-        elif type_ == 'code':
-            text += '```\n%s\n```\n\n' % block['data']['code']
-        elif type_ == 'image':
-            if block['data'].get('url'):
-                text += '![](%s)\n\n' % block['data']['url']
-            elif block['data'].get('file'):
-                text += '![](%s)\n\n' % block['data']['file']['url']
-        elif type_ == 'checklist':
-            for item in  block['data']['items']:
-                text += '[%s] %s\n' % ('X' if item['checked'] else '', _replace_br(item['text']))
-            text += '\n'
-        elif block['data'].get('text'):
-            text += '%s\n\n' % _replace_br(block['data']['text'])
-    return text
 
 def text_to_js(text):
     '''
     Converts text to a dictionary of datablocks to be used with editorJS using
-    Markdown-like structure
+    Markdown-like structure.
+
+    text is a string or a file-like object of lines. Consecutive list items
+    and the lines of fenced code are grouped into a single block.
     '''
     datablocks = []
-    text_blocks = text.split('\n')
-    for block in text_blocks:
-        if not block:
+    marker = items = None
+    for kind, data in _lex_markdown(_md_lines(text)):
+        if kind == marker:
+            items.append(data)
             continue
-        current_block = {'data' : {}}
-        block = block.strip('\n')
-        block = block.replace('\\', '')
-        block = block.strip()
-        if len(block) > 0:
-            block = block.replace('[![]', '[!]')
-            match block[0]:
-                case '#':
-                    current_block['type'] = 'header'
-                    current_block['data']['level'] = len(block.split(' ')[0])
-                    current_block['data']['text'] = block.strip('#').strip(' ')
-                    datablocks.append(current_block.copy())
-                case '-':
-                    if block == '--':
-                        current_block['type'] = 'paragraph'
-                        current_block['data']['text'] = block.strip(' ')
-                        if len(current_block['data']['text'].strip(' ')) > 0:
-                            datablocks.append(current_block.copy())
-                    elif len(block) > 2:
-                        if block[1] and block[2]:
-                            if block[1] == '-' and block[2] == '-':
-                                current_block['type'] = 'delimeter'
-                                current_block['data'] = {}
-                                datablocks.append(current_block.copy())
-                            else:
-                                current_block['type'] = 'list'
-                                current_block['data']['style'] = 'unordered'
-                                current_block['data']['items'] = [b.strip('-') for b in block.split('\n')]
-                                datablocks.append(current_block.copy())
-                case '1':
-                    if len(block) > 1:
-                        if block[1] == '.':
-                            current_block['type'] = 'list'
-                            current_block['data']['style'] = 'ordered'
-                            current_block['data']['items'] = [b[2:] for b in block.split('\n')]
-                            datablocks.append(current_block.copy())
-                case '`':
-                    current_block['type'] = 'code'
-                    current_block['data']['code'] = block.strip('`')
-                    datablocks.append(current_block.copy())
-                case '>':
-                    if len(block) > 1:
-                        if block[0] and block[1]:
-                            current_block['type'] = 'list'
-                            current_block['data']['style'] = 'unordered'
-                            current_block['data']['items'] = [b.strip('>') for b in block.split('\n')]
-                            datablocks.append(current_block.copy())
-                case '!':
-                    current_block['type'] = 'image'
-                    block = re.sub(r"!\[[^\]]*\]", '', block)
-                    current_block['data']['url'] = block.strip('[').split(':')[-1].strip(']').strip()
-                    #str(attachment_id_from_name(block.strip('[').split(':')[-1].strip(']')))
-                    datablocks.append(current_block.copy())
-                case '<':
-                    if re.match(r'\<image>', block):
-                        current_block['type'] = 'image'
-                        current_block['data']['url'] = block.strip('<').split(':')[-1].strip('>').strip()
-                        #str(attachment_id_from_name(block.strip('<').split(':')[-1].strip('>')))
-                        datablocks.append(current_block.copy())
-                case '[':
-                    if re.match(r'\[image', block) or re.match(r'\[!]', block):
-
-                        block = re.sub(r"\[!\]", '', block)
-                        current_block['type'] = 'image'
-                        current_block['data']['url'] = block.strip('(').strip(')')
-                        #str(attachment_id_from_name(block.strip('[').split(':')[-1].strip(']')))
-                        datablocks.append(current_block.copy())
-                case _:
-                    current_block['type'] = 'paragraph'
-                    current_block['data']['text'] = block.strip(' ')
-                    if len(current_block['data']['text'].strip(' ')) > 0:
-                        datablocks.append(current_block.copy())
-    return json.dumps({'blocks': datablocks})
-
-def html_to_js(html_string, is_mail=False):
+        marker = None
+        if kind == 'block':
+            datablocks.append(data)
+        elif kind != 'blank':
+            marker, items = kind, [data]
+            datablocks.append({'data': {
+                        'style': 'ordered' if kind == '1.' else 'unordered',
+                        'items': items,
+                        }, 'type': 'list'})
+    return codec.dumps({'blocks': datablocks})
+
+MAIL_HTML_MAX_SIZE = config.getint('widgets', 'mail_html_max_size',
+    default=10 * 1024 * 1024)
+MAIL_HTML_MAX_DEPTH = config.getint('widgets', 'mail_html_max_depth',
+    default=64)
+_MAIL_CHUNK_SIZE = 64 * 1024
+_MAIL_SKIP = {'head', 'script', 'style', 'title', 'meta', 'link', 'noscript',
+    'template', 'svg', 'object', 'iframe'}
+_MAIL_INLINE = {'a', 'b', 'strong', 'i', 'em', 'u', 's', 'code', 'mark',
+    'br'}
+_MAIL_BLOCKS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'pre',
+    'blockquote', 'ul', 'ol', 'img', 'hr', 'table'}
+_MAIL_CONTAINERS = {'html', 'body', 'div', 'section', 'article', 'header',
+    'footer', 'main', 'nav', 'aside', 'center', 'form', 'fieldset', 'figure',
+    'address', 'dl', 'dd', 'dt', 'li', 'tbody', 'thead', 'tfoot', 'tr', 'td',
+    'th', 'caption'}
+_MAIL_TEXT_BLOCKS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'blockquote'}
+_MAIL_BLOCK_TAGS = _MAIL_BLOCKS | (_MAIL_CONTAINERS - {'li', 'dd', 'dt'})
+_MAIL_LAYOUT_TAGS = {'table', 'p', 'div', 'ul', 'ol', 'h1', 'h2', 'h3', 'img'}
+_MAIL_SPACES = re.compile(r'\s+')
+_MAIL_UNSAFE_URL = re.compile(r'\s*(javascript|vbscript|data):', re.I)
+
+
+def _mail_text(text):
+    return html_escape(_MAIL_SPACES.sub(' ', text), quote=False)
+
+
+def _mail_inline(element, depth, parts):
+    '''
+    Appends to parts the clean inline HTML of element without its tail:
+    only the tags of _MAIL_INLINE are kept and the others are replaced by
+    their text
+    '''
+    tag = element.tag
+    if not isinstance(tag, str) or tag in _MAIL_SKIP:
+        return
+    if depth > MAIL_HTML_MAX_DEPTH:
+        parts.append(_mail_text(''.join(element.itertext())))
+        return
+    if tag == 'br':
+        parts.append('<br>')
+        return
+    keep = tag in _MAIL_INLINE
+    if keep:
+        href = element.get('href')
+        if tag == 'a' and href and not _MAIL_UNSAFE_URL.match(href):
+            parts.append('<a href="%s">' % html_escape(href))
+        else:
+            parts.append('<%s>' % tag)
+    if element.text:
+        parts.append(_mail_text(element.text))
+    for child in element:
+        _mail_inline(child, depth + 1, parts)
+        if child.tail:
+            parts.append(_mail_text(child.tail))
+    if keep:
+        parts.append('</%s>' % tag)
+
+
+def _mail_inner(element, depth):
+    parts = []
+    if element.text:
+        parts.append(_mail_text(element.text))
+    for child in element:
+        _mail_inline(child, depth + 1, parts)
+        if child.tail:
+            parts.append(_mail_text(child.tail))
+    return ''.join(parts).strip()
+
+
+def _mail_items(element, depth):
+    '''
+    Yields the items of the list element with the nested lists as their own
+    items as EditorJS lists are flat
+    '''
+    if depth > MAIL_HTML_MAX_DEPTH:
+        yield _mail_text(''.join(element.itertext())).strip()
+        return
+    for child in element:
+        if child.tag in {'ul', 'ol'}:
+            yield from _mail_items(child, depth + 1)
+        elif child.tag == 'li':
+            parts, nested = [], []
+            if child.text:
+                parts.append(_mail_text(child.text))
+            for descendant in child:
+                if descendant.tag in {'ul', 'ol'}:
+                    nested.append(descendant)
+                else:
+                    if parts and descendant.tag in _MAIL_BLOCK_TAGS:
+                        parts.append('<br>')
+                    _mail_inline(descendant, depth + 2, parts)
+                if descendant.tail:
+                    parts.append(_mail_text(descendant.tail))
+            yield ''.join(parts).strip()
+            for list_ in nested:
+                yield from _mail_items(list_, depth + 2)
+
+
+def _mail_has(element, tags):
+    return next(element.iterdescendants(*tags), None) is not None
+
+
+class _MailBlocks:
+    "Converts HTML elements into EditorJS blocks"
+
+    def __init__(self):
+        self.blocks = []
+        self._inline = []
+
+    def add_text(self, text):
+        if text:
+            self._inline.append(_mail_text(text))
+
+    def flush(self):
+        text = ''.join(self._inline).strip()
+        self._inline = []
+        if text and text != '<br>':
+            self.blocks.append({'type': 'paragraph', 'data': {'text': text}})
+
+    def add(self, element, depth=0):
+        "Adds the blocks of element without its tail"
+        tag = element.tag
+        if not isinstance(tag, str) or tag in _MAIL_SKIP:
+            return
+        if depth > MAIL_HTML_MAX_DEPTH:
+            self.add_text(''.join(element.itertext()))
+            return
+        # Tables containing blocks are used for layout and the images can not
+        # be inlined in the text blocks so they are split around them
+        if tag in _MAIL_BLOCKS and not (
+                tag == 'table' and _mail_has(element, _MAIL_LAYOUT_TAGS)
+                or tag in _MAIL_TEXT_BLOCKS and _mail_has(element, {'img'})):
+            self.flush()
+            block = self._block(element, depth)
+            if block:
+                self.blocks.append(block)
+        elif (tag in _MAIL_CONTAINERS
+                or _mail_has(element, _MAIL_BLOCK_TAGS)):
+            self.flush()
+            self.add_text(element.text)
+            for child in element:
+                self.add(child, depth + 1)
+                self.add_text(child.tail)
+            self.flush()
+        else:
+            _mail_inline(element, depth, self._inline)
+
+    def _block(self, element, depth):
+        tag = element.tag
+        if tag[0] == 'h' and tag[1:].isdigit():
+            text = _mail_inner(element, depth)
+            if text:
+                return {'type': 'header', 'data': {
+                        'text': text, 'level': int(tag[1])}}
+        elif tag == 'p':
+            text = _mail_inner(element, depth)
+            if text and text != '<br>':
+                return {'type': 'paragraph', 'data': {'text': text}}
+        elif tag == 'pre':
+            code = ''.join(element.itertext()).strip('\n')
+            if code:
+                return {'type': 'code', 'data': {'code': code}}
+        elif tag == 'blockquote':
+            text = _mail_inner(element, depth)
+            if text:
+                return {'type': 'quote', 'data': {
+                        'text': text,
+                        'caption': html_escape(element.get('cite', '')),
+                        'alignment': 'left',
+                        }}
+        elif tag in {'ul', 'ol'}:
+            items = [i for i in _mail_items(element, depth) if i]
+            if items:
+                return {'type': 'list', 'data': {
+                        'style': 'ordered' if tag == 'ol' else 'unordered',
+                        'items': items,
+                        }}
+        elif tag == 'img':
+            if element.get('src'):
+                return {'type': 'image', 'data': {
+                        'file': {'url': element.get('src')},
+                        'caption': html_escape(element.get('alt', '')),
+                        }}
+        elif tag == 'hr':
+            return {'type': 'delimeter', 'data': {}}
+        elif tag == 'table':
+            content, with_headings = [], False
+            for row in element.iter('tr'):
+                cells = [c for c in row if c.tag in {'td', 'th'}]
+                if not content and cells and all(
+                        c.tag == 'th' for c in cells):
+                    with_headings = True
+                content.append([_mail_inner(c, depth + 1) for c in cells])
+            if any(any(r) for r in content):
+                return {'type': 'table', 'data': {
+                        'withHeadings': with_headings,
+                        'content': content,
+                        }}
+
+
+def iter_html_blocks(html, max_size=None, encoding=None):
+    '''
+    Yields the EditorJS blocks of the HTML string, bytes or file-like object
+    as soon as each child of the body is parsed.
+
+    encoding is the charset of bytes input, for example the one of the mail
+    part, otherwise it is detected from the meta tags.
+    Only the first max_size characters are converted (default
+    widgets/mail_html_max_size) and the elements nested deeper than
+    widgets/mail_html_max_depth are reduced to their text.
+    '''
+    if max_size is None:
+        max_size = MAIL_HTML_MAX_SIZE
+    if isinstance(html, (str, bytes)):
+        chunks = (html[i:i + _MAIL_CHUNK_SIZE]
+            for i in range(0, len(html), _MAIL_CHUNK_SIZE))
+    else:
+        chunks = iter(partial(html.read, _MAIL_CHUNK_SIZE), html.read(0))
+
+    # huge_tree lifts the libxml2 nesting limit which would stop the events
+    parser = etree.HTMLPullParser(events=('end',), remove_comments=True,
+        huge_tree=True, encoding=encoding)
+    blocks = _MailBlocks()
+    previous = None
+
+    def convert(element):
+        nonlocal previous
+        if element.tag == 'body':
+            blocks.add_text(
+                element.text if previous is None else previous.tail)
+            return
+        parent = element.getparent()
+        if parent is None or parent.tag != 'body':
+            return
+        # The tail of a child is complete only once the next one is parsed
+        if previous is None:
+            blocks.add_text(parent.text)
+        else:
+            blocks.add_text(previous.tail)
+            parent.remove(previous)
+        blocks.add(element, depth=2)
+        element.clear(keep_tail=True)
+        previous = element
+
+    size = 0
+    for chunk in chunks:
+        if size + len(chunk) > max_size:
+            logger.warning('HTML truncated to %s characters', max_size)
+            chunk = chunk[:max_size - size]
+        size += len(chunk)
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            convert(element)
+        yield from blocks.blocks
+        blocks.blocks.clear()
+        if size >= max_size:
+            break
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        pass
+    for _, element in parser.read_events():
+        convert(element)
+    blocks.flush()
+    yield from blocks.blocks
+
+
+def html_to_js(html_string, is_mail=False, encoding=None):
     if not is_mail:
         converted = html2text(html_string, bodywidth=0)
         processed = text_to_js(converted)
@@ -278,85 +1213,8 @@ def html_to_js(html_string, is_mail=False):
     else:
         if html_string == '' or html_string is None:
             return ''
-        datablocks = []
-        html_json = BeautifulSoup(html_string, 'lxml')
-        for component in html_json.find_all(recursive=False):
-            current_block = {'data': {}}
-            if not re.match(component.name, 'h[1-6]'):
-                if len(component) > 0:
-                    match component.name:
-                        case 'p':
-                            current_block['type'] = 'paragraph'
-                            current_block['data']['text'] = str(component.contents)
-                            datablocks.append(current_block.copy())
-                        case 'delimeter':
-                            current_block['type'] = 'delimeter'
-                            current_block['data'] = {}
-                            datablocks.append(current_block.copy())
-                        case 'code':
-                            current_block['type'] = 'code'
-                            current_block['data']['code'] = str(component.contents).strip('`')
-                            datablocks.append(current_block.copy())
-                        case 'blockquote':
-                            current_block['type'] = 'quote'
-                            current_block['data']['caption'] = str(component.find('cite'))
-                            current_block['data']['text'] = str(component.find())
-                        case 'ul':
-                            current_block['type'] = 'list'
-                            current_block['data']['style'] = 'unordered'
-                            current_block['data']['items'] = []
-                            for list_entry in component.find_all('li'):
-                                current_block['data']['items'].append(list_entry.contents)
-                            datablocks.append(current_block.copy())
-                        case 'ol':
-                            current_block['type'] = 'list'
-                            current_block['data']['style'] = 'ordered'
-                            current_block['data']['items'] = []
-                            for list_entry in component.find_all('li'):
-                                current_block['data']['items'].append(list_entry.contents)
-                            datablocks.append(current_block.copy())
-                        case 'form':
-                            current_block['type'] = 'checklist'
-                            current_block['data']['items'] = []
-                            for input in component.find_all('input'):
-                                if input.find('checked') == 'true':
-                                    checked = 'True'
-                                else:
-                                    checked = 'False'
-                                checkbox = {
-                                    'checked': checked,
-                                    'text': str(input.find())
-                                }
-                                current_block['data']['items'].append(checkbox)
-                            datablocks.append(current_block.copy())
-                        case 'table':
-                            current_block['type'] = 'table'
-                            current_block['data'] = []
-                            current_block['data']['content'] = []
-                            for t_row in component.contents:
-                                if t_row.name == 'th':
-                                    current_block['data']['withHeadings'] = True
-                                if t_row.name == 'tr' or t_row.name == 'th':
-                                    row = []
-                                    for cell in t_row.contents:
-                                        if cell.name == 'td':
-                                            row.append(cell.contents[0])
-                                    current_block['data']['content'].append(row)
-                            datablocks.append(current_block.copy())
-                        case 'img':
-                            current_block['type'] = 'image'
-                            current_block['data']['file'] = {}
-                            current_block['data']['file']['url'] = str(component)
-                            datablocks.append(current_block.copy())
-                        case _:
-                            current_block['type'] = 'paragraph'
-                            current_block['data']['text'] = str(component.contents).strip('[').strip(']')
-                            datablocks.append(current_block.copy())
-            else:
-                current_block['data']['level'] = int(component.name[1])
-                current_block['data']['text'] = str(component.contents)
-                datablocks.append(current_block.copy())
-        return json.dumps({'blocks': datablocks})
+        return codec.dumps({'blocks': list(
+                    iter_html_blocks(html_string, encoding=encoding))})
 
 def url_from_tryton_to_flask(url, prefix):
     attachment = attachment_from_url(url)
@@ -364,9 +1222,11 @@ def url_from_tryton_to_flask(url, prefix):
         return url
     return prefix + attachment.name
 
-def cid_from_attachment(attachment):
-    return hashlib.md5((attachment.name + '/' + str(attachment.id)
-            ).encode('utf-8')).hexdigest()
+def cid_from_attachment(attachment, width=None):
+    key = attachment.name + '/' + str(attachment.id)
+    if width:
+        key += '/' + str(width)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
 
 def attachment_from_name(name):
     pool = Pool()
@@ -382,38 +1242,177 @@ def attachment_from_id(id):
     if attachments:
         return attachments[0]
 
-def attachment_from_url(url):
+def attachment_id_from_url(url):
     if not 'widgets/attachment' in url:
         return
     id_ = url.split('/')[-1]
     try:
-        id_ = int(id_)
+        return int(id_)
     except ValueError:
         return
+
+def attachment_from_url(url):
+    id_ = attachment_id_from_url(url)
+    if id_ is None:
+        return
     return attachment_from_id(str(id_))
 
-def migrate_field(sql_table, field, type):
+def attachments_from_urls(urls):
+    '''
+    Returns a dictionary with the attachments referenced by urls indexed by id
+    using a single search
+    '''
+    ids = {attachment_id_from_url(url) for url in urls}
+    ids.discard(None)
+    if not ids:
+        return {}
+    pool = Pool()
+    Attachment = pool.get('ir.attachment')
+    return {a.id: a for a in Attachment.search([('id', 'in', list(ids))])}
+
+def image_urls(blocks):
+    '''
+    Returns the urls of the image blocks
+    '''
+    urls = []
+    for block in blocks:
+        if block.get('type') != 'image':
+            continue
+        url = block['data'].get('file', {}).get('url')
+        if url:
+            urls.append(url)
+    return urls
+
+def image_sources(urls, url_prefix='', width=None):
+    '''
+    Returns a dictionary with the src of every image url in the url_prefix
+    mode of js_to_html resolving all the attachments at once
+
+    When width is set, the sources which point to the attachment route
+    request the images downscaled to width. The url_prefix ones are kept as
+    is as nothing tells that they support it.
+    '''
+    urls = set(urls)
+    attachments = attachments_from_urls(urls)
+    if url_prefix == 'base64' and attachments:
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        data = {a['id']: a['data']
+            for a in Attachment.read(list(attachments), ['data'])}
+
+    sources = {}
+    for url in urls:
+        attachment = attachments.get(attachment_id_from_url(url))
+        if url_prefix == 'cid:':
+            src = None
+            if attachment:
+                src = 'cid:' + cid_from_attachment(attachment, width)
+        elif url_prefix == 'base64':
+            src = None
+            if attachment:
+                content, mimetype = data[attachment.id], ''
+                variant = image.get_variant(attachment, width, content)
+                if variant:
+                    content, mimetype = variant
+                src = 'data:%s;base64,' % mimetype + base64.b64encode(
+                    content).decode('utf-8')
+        elif attachment:
+            src = url_prefix + attachment.name
+        elif width and attachment_id_from_url(url) is not None:
+            src = url + '?w=%s' % width
+        else:
+            src = url
+        sources[url] = src
+    return sources
+
+def bulk_update(sql_table, field, values):
+    '''
+    Sets field of sql_table to the values of the (id, value) pairs with a
+    single UPDATE ... FROM (VALUES ...) or one UPDATE per row on SQLite
+    '''
+    if not values:
+        return
     cursor = Transaction().connection.cursor()
+    if backend.name == 'sqlite':
+        for id, value in values:
+            cursor.execute(*sql_table.update(
+                    columns=[field],
+                    values=[value],
+                    where=sql_table.id == id))
+    else:
+        values = Values(values)
+        cursor.execute(*sql_table.update(
+                columns=[field],
+                values=[Column(values, 'column2')],
+                from_=[values],
+                where=sql_table.id == Column(values, 'column1')))
+
+def migrate_field(sql_table, field, type, batch_size=1000,
+        max_workers=None):
+    '''
+    Converts the html (type='html') or text values of field into editorJS.
+
+    Rows are read in batches of batch_size ordered by id and every batch is
+    written back with a single UPDATE and committed together with a
+    checkpoint, so an interrupted migration resumes after the last committed
+    batch. When max_workers is set, the conversion runs in a pool of
+    processes.
+    '''
+    pool = Pool()
+    Checkpoint = pool.get('widgets.migration.checkpoint')
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
     if type == 'html':
         tool = html_to_js
     else:
         tool = text_to_js
-    cursor.execute(*sql_table.select(sql_table.id, field, where=((field != None))))
-    records = cursor.fetchall()
-    counter = 0
-    for id, value in records:
-        counter += 1
-        if counter % 1000 == 0:
-            Transaction().connection.commit()
-        if '"blocks"' not in value:
-            cursor.execute(*sql_table.update(
-                columns=[field],
-                values=[tool(value)],
-                where=sql_table.id == id
-            ))
+
+    table_name, column_name = sql_table._name, field.name
+    last_id = Checkpoint.get_last_id(table_name, column_name)
+    cursor.execute(*sql_table.select(Count(Literal('*')),
+            where=(field != Null) & (sql_table.id > last_id)))
+    total, = cursor.fetchone()
+    logger.info('migrating %s rows of %s.%s from id %s',
+        total, table_name, column_name, last_id)
+
+    executor = None
+    if max_workers:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    start = time.monotonic()
+    done = 0
+    try:
+        while True:
+            cursor.execute(*sql_table.select(sql_table.id, field,
+                    where=(field != Null) & (sql_table.id > last_id),
+                    order_by=sql_table.id.asc, limit=batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            records = [(id, value) for id, value in rows
+                if not codec.is_document(value)]
+            values = [value for _, value in records]
+            if executor:
+                chunksize = max(1, len(values) // (max_workers * 4))
+                values = executor.map(tool, values, chunksize=chunksize)
+            else:
+                values = map(tool, values)
+            values = [(id, value)
+                for (id, _), value in zip(records, values)]
+            bulk_update(sql_table, field, values)
+            Checkpoint.set_last_id(table_name, column_name, last_id)
+            transaction.connection.commit()
+
+            done += len(rows)
+            elapsed = time.monotonic() - start
+            rate = done / elapsed if elapsed else 0
+            eta = (total - done) / rate if rate else 0
+            logger.info('%s.%s: %s/%s rows, %.0f rows/s, ETA %ds',
+                table_name, column_name, done, total, rate, eta)
+    finally:
+        if executor:
+            executor.shutdown()
+    Checkpoint.set_last_id(table_name, column_name, None)
 
 def has_content(jstext):
-    if not jstext:
-        return False
-    content = json.loads(jstext)
-    return bool(content.get('blocks'))
+    return codec.has_blocks(jstext)
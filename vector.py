@@ -1,38 +1,257 @@
+import io
 import json
+import struct
+from itertools import islice
 
+from sql import Cast, Column, Null
+from sql.functions import Function
+from sql.operators import BinaryOperator
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
 from trytond.model import fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class L2Distance(BinaryOperator):
+    __slots__ = ()
+    _operator = '<->'
+
+
+class CosineDistance(BinaryOperator):
+    __slots__ = ()
+    _operator = '<=>'
+
+
+class NegativeInnerProduct(BinaryOperator):
+    __slots__ = ()
+    _operator = '<#>'
+
+
+class HammingDistance(BinaryOperator):
+    __slots__ = ()
+    _operator = '<~>'
+
+
+class BinaryQuantize(Function):
+    __slots__ = ()
+    _function = 'BINARY_QUANTIZE'
+
+
+# metric: (operator, suffix of the operator class)
+METRICS = {
+    'l2': (L2Distance, 'l2_ops'),
+    'cosine': (CosineDistance, 'cosine_ops'),
+    'inner_product': (NegativeInnerProduct, 'ip_ops'),
+    }
+STORAGES = {'vector', 'halfvec'}
+
+
+class VectorIndex:
+    '''
+    Define a pgvector approximate nearest neighbour index of a Vector field.
+
+    With quantization (halfvec or bit), the index is built on the column cast
+    to halfvec or binary quantized to bit and the nearest candidates found
+    with it are re-ranked with the full precision values, rerank times the
+    number of requested records are fetched from the index.
+    '''
+    __slots__ = ('method', 'metric', 'm', 'ef_construction', 'lists',
+        'quantization', 'rerank')
+
+    def __init__(self, method='hnsw', metric='l2', m=None,
+            ef_construction=None, lists=None, quantization=None, rerank=4):
+        assert method in {'hnsw', 'ivfflat'}, method
+        assert metric in METRICS, metric
+        assert quantization in {None, 'halfvec', 'bit'}, quantization
+        self.method = method
+        self.metric = metric
+        self.m = m
+        self.ef_construction = ef_construction
+        self.lists = lists
+        self.quantization = quantization
+        self.rerank = rerank
+
+    def expression(self, column, field):
+        "Return the indexed expression of column"
+        if self.quantization == 'halfvec':
+            return Cast(column, 'halfvec(%s)' % field.size)
+        elif self.quantization == 'bit':
+            return Cast(BinaryQuantize(column), 'bit(%s)' % field.size)
+        return column
+
+    def distance(self, column, vector, field):
+        "Return the distance expression of column to vector using the index"
+        if self.quantization == 'bit':
+            return HammingDistance(self.expression(column, field),
+                BinaryQuantize(vector_literal(vector)))
+        elif self.quantization == 'halfvec':
+            return METRICS[self.metric][0](self.expression(column, field),
+                vector_literal(vector, 'halfvec(%s)' % field.size))
+        return METRICS[self.metric][0](
+            column, vector_literal(vector, field.storage))
+
+    def options(self):
+        if self.method == 'hnsw':
+            options = [('m', self.m), ('ef_construction', self.ef_construction)]
+        else:
+            options = [('lists', self.lists)]
+        return ', '.join(
+            '%s = %d' % (k, v) for k, v in options if v is not None)
+
+    def create_sql(self, table, column, field):
+        name = '%s_%s_%s_%s' % (table, column, self.method, self.metric)
+        expression = '"%s"' % column
+        if self.quantization == 'halfvec':
+            name += '_halfvec'
+            expression = '(%s::halfvec(%s))' % (expression, field.size)
+            opclass = 'halfvec_' + METRICS[self.metric][1]
+        elif self.quantization == 'bit':
+            name += '_bit'
+            expression = '(binary_quantize(%s)::bit(%s))' % (
+                expression, field.size)
+            opclass = 'bit_hamming_ops'
+        else:
+            opclass = '%s_%s' % (field.storage, METRICS[self.metric][1])
+        sql = 'CREATE INDEX IF NOT EXISTS "%s" ON "%s" USING %s (%s %s)' % (
+            name, table, self.method, expression, opclass)
+        options = self.options()
+        if options:
+            sql += ' WITH (%s)' % options
+        return sql
+
+
+def vector_literal(vector, type_='vector'):
+    "Return the SQL expression of vector"
+    return Cast('[%s]' % ','.join(repr(float(x)) for x in vector), type_)
+
+
+def _check_numpy():
+    if np is None:
+        raise UserError(gettext('widgets.msg_numpy_required'))
+
+
+def _to_array(data):
+    "Convert a database value into a float32 numpy array without copy"
+    if isinstance(data, (bytes, memoryview)):
+        return np.frombuffer(data, dtype='<f4')
+    if isinstance(data, str):
+        data = json.loads(data)
+    return np.asarray(data, dtype=np.float32)
+
+
+def _to_blob(value):
+    "Pack value as little-endian float32 for SQLite"
+    if np is not None:
+        return np.asarray(value, dtype='<f4').tobytes()
+    return struct.pack('<%df' % len(value), *value)
+
+
+def _distances(matrix, vector, metric):
+    "Return the distances between the rows of matrix and vector"
+    if metric == 'l2':
+        return np.sqrt(((matrix - vector) ** 2).sum(axis=1))
+    products = matrix @ vector
+    if metric == 'inner_product':
+        return -products
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - products / norms
+
+
+def create_vector_functions():
+    '''
+    Register on SQLite the vector_l2_distance, vector_cosine_distance and
+    vector_negative_inner_product functions of float32 BLOBs
+    '''
+    if backend.name != 'sqlite':
+        return
+    _check_numpy()
+    conn = Transaction().connection
+    for name, metric in [
+            ('vector_l2_distance', 'l2'),
+            ('vector_cosine_distance', 'cosine'),
+            ('vector_negative_inner_product', 'inner_product'),
+            ]:
+        def distance(a, b, metric=metric):
+            if a is None or b is None:
+                return None
+            a = _to_array(a)
+            return float(_distances(a[np.newaxis, :], _to_array(b), metric)[0])
+        conn.create_function(name, 2, distance)
 
 
 class Vector(fields.Field):
+    '''
+    Define a pgvector field (``list`` of ``float``).
+
+    When numpy is set or the context has vector_numpy, values are returned
+    as float32 ``numpy.ndarray``. index is a VectorIndex created by
+    VectorSearchMixin. storage is vector or halfvec (half precision) on
+    PostgreSQL.
+    '''
     _type = 'vector'
     _py_type = list
 
     def __init__(self, string='', size=None, help='', required=False,
             readonly=False, domain=None, states=None, on_change=None,
             on_change_with=None, depends=None, context=None,
-            loading='eager'):
+            loading='eager', numpy=False, index=None, storage='vector'):
         super().__init__(string=string, help=help, required=required,
             readonly=readonly, domain=domain, states=states,
             on_change=on_change, on_change_with=on_change_with,
             depends=depends, context=context, loading=loading)
         self.size = size
+        self.numpy = numpy
+        self.index = index
+        assert storage in STORAGES, storage
+        self.storage = storage
+        if index and index.quantization:
+            assert isinstance(size, int), 'quantization requires a size'
 
     @property
     def _sql_type(self):
+        if backend.name == 'sqlite':
+            return 'BLOB'
         if isinstance(self.size, int):
-            return 'vector(%s)' % self.size
+            return '%s(%s)' % (self.storage, self.size)
         else:
-            return 'vector'
+            return self.storage
+
+    def sql_format(self, value):
+        if backend.name == 'sqlite' and value is not None and not isinstance(
+                value, (bytes, str)):
+            return _to_blob(value)
+        return super().sql_format(value)
 
     def get(self, ids, model, name, values=None):
         vectors = dict((id, None) for id in ids)
+        as_numpy = np is not None and (self.numpy
+            or Transaction().context.get('vector_numpy'))
         for value in values or []:
             data = value.get(name)
             if data is None:
                 vectors[value['id']] = None
                 continue
 
+            if as_numpy:
+                vectors[value['id']] = _to_array(data)
+                continue
+
             # pgvector + psycopg may return numpy arrays; normalize to list.
+            if isinstance(data, (bytes, memoryview)):
+                if np is not None:
+                    data = _to_array(data)
+                else:
+                    data = struct.unpack('<%df' % (len(data) // 4), data)
             if hasattr(data, 'tolist'):
                 data = data.tolist()
             elif isinstance(data, str):
@@ -52,3 +271,204 @@ class Vector(fields.Field):
 
             vectors[value['id']] = data
         return vectors
+
+
+def read_array(Model, ids, name):
+    '''
+    Returns a contiguous float32 2-D numpy array with the vectors of field
+    name of the records ids in the same order.
+
+    Rows of records without value or not readable are filled with NaN.
+    '''
+    _check_numpy()
+    cursor = Transaction().connection.cursor()
+    table = Model.__table__()
+    column = getattr(table, name)
+    field = Model._fields[name]
+    index = {id_: i for i, id_ in enumerate(ids)}
+    array = None
+    if isinstance(field.size, int):
+        array = np.full((len(ids), field.size), np.nan, dtype=np.float32)
+    for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+        sub_ids = list(sub_ids)
+        cursor.execute(*table.select(table.id, column,
+                where=table.id.in_(
+                    Model.search([('id', 'in', sub_ids)], query=True))
+                & (column != Null)))
+        for id_, data in cursor:
+            data = _to_array(data)
+            if array is None:
+                array = np.full(
+                    (len(ids), data.shape[0]), np.nan, dtype=np.float32)
+            array[index[id_]] = data
+    if array is None:
+        array = np.empty((len(ids), 0), dtype=np.float32)
+    return array
+
+
+class VectorSearchMixin:
+    __slots__ = ()
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        if backend.name != 'postgresql':
+            return
+        cursor = Transaction().connection.cursor()
+        for name, field in cls._fields.items():
+            if isinstance(field, Vector) and field.index:
+                cursor.execute(
+                    field.index.create_sql(cls._table, name, field))
+
+    @classmethod
+    def nearest(cls, name, vector, k=10, metric=None, domain=None,
+            ef_search=None, probes=None):
+        '''
+        Returns the list of (record, distance) of the k records which vector
+        of field name is the nearest to vector ordered by distance.
+
+        metric is l2, cosine or inner_product (the negative inner product is
+        returned) and defaults to the one of the field index. ef_search and
+        probes set hnsw.ef_search and ivfflat.probes for the query.
+
+        When the field index is quantized, the candidates found with it are
+        re-ranked with the full precision values.
+        '''
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        ModelAccess.check(cls.__name__, 'read')
+        field = cls._fields[name]
+        if metric is None:
+            metric = field.index.metric if field.index else 'l2'
+        if backend.name != 'postgresql':
+            return cls._nearest_brute_force(name, vector, k, metric, domain)
+        cursor = Transaction().connection.cursor()
+        for setting, value in [
+                ('hnsw.ef_search', ef_search),
+                ('ivfflat.probes', probes),
+                ]:
+            if value is not None:
+                cursor.execute('SELECT set_config(%s, %s, true)',
+                    (setting, str(int(value))))
+        table = cls.__table__()
+        column = Column(table, name)
+        literal = vector_literal(vector, field.storage)
+        where = (column != Null) & table.id.in_(
+            cls.search(domain or [], query=True))
+        index = field.index
+        if index and index.quantization and (
+                index.quantization == 'bit' or index.metric == metric):
+            # Search the candidates with the quantized index
+            # and re-rank them with full precision
+            candidates = table.select(table.id.as_('id'),
+                column.as_('vector'),
+                where=where,
+                order_by=[index.distance(column, vector, field).asc],
+                limit=k * index.rerank)
+            distance = METRICS[metric][0](candidates.vector, literal)
+            query = candidates.select(candidates.id, distance,
+                order_by=[distance.asc], limit=k)
+        else:
+            distance = METRICS[metric][0](column, literal)
+            query = table.select(table.id, distance,
+                where=where, order_by=[distance.asc], limit=k)
+        cursor.execute(*query)
+        return [(cls(id_), distance) for id_, distance in cursor]
+
+    @classmethod
+    def _nearest_brute_force(cls, name, vector, k, metric, domain,
+            batch_size=10000):
+        "Compute nearest with numpy reading the vectors by batch"
+        _check_numpy()
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        column = Column(table, name)
+        where = (column != Null) & table.id.in_(
+            cls.search(domain or [], query=True))
+        vector = np.asarray(vector, dtype=np.float32)
+        best_ids = np.empty(0, dtype=np.int64)
+        best_distances = np.empty(0, dtype=np.float32)
+        cursor.execute(*table.select(table.id, column, where=where))
+        while rows := cursor.fetchmany(batch_size):
+            ids = np.fromiter((r[0] for r in rows), dtype=np.int64,
+                count=len(rows))
+            matrix = np.stack([_to_array(r[1]) for r in rows])
+            ids = np.concatenate([best_ids, ids])
+            distances = np.concatenate(
+                [best_distances, _distances(matrix, vector, metric)])
+            if len(distances) > k:
+                selected = np.argpartition(distances, k - 1)[:k]
+                ids, distances = ids[selected], distances[selected]
+            best_ids, best_distances = ids, distances
+        order = np.argsort(best_distances, kind='stable')
+        return [(cls(int(id_)), float(distance))
+            for id_, distance in zip(best_ids[order], best_distances[order])]
+
+
+def _copy_binary(rows, storage):
+    "Return the PostgreSQL binary COPY data of the (id, vector) rows"
+    dtype, format_ = ('>f2', 'e') if storage == 'halfvec' else ('>f4', 'f')
+    data = io.BytesIO()
+    data.write(b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0))
+    for id_, vector in rows:
+        if np is not None:
+            values = np.asarray(vector, dtype=dtype).tobytes()
+        else:
+            values = struct.pack('>%d%s' % (len(vector), format_), *vector)
+        dimension = len(values) // int(dtype[-1])
+        data.write(struct.pack('>hii', 2, 4, id_))
+        data.write(struct.pack('>ihh', 4 + len(values), dimension, 0))
+        data.write(values)
+    data.write(struct.pack('>h', -1))
+    data.seek(0)
+    return data
+
+
+def load_vectors(Model, name, vectors, batch_size=10000, progress=None):
+    '''
+    Stores the (id, vector) pairs of the iterable vectors into the Vector
+    field name of Model, for example zip(ids, array) of a 2-D numpy array.
+
+    On PostgreSQL each batch of batch_size pairs is sent with a binary COPY
+    into a temporary staging table and merged into the column with a single
+    UPDATE. Other backends use a batched executemany. progress is called
+    with the number of pairs stored after each batch.
+
+    The values are written directly in the table without calling write.
+    '''
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    field = Model._fields[name]
+    use_copy = backend.name == 'postgresql' and hasattr(cursor, 'copy_expert')
+    # The staging table depends on the storage as it may be reused by
+    # another field in the same transaction
+    staging = 'widgets_vector_staging_%s' % field.storage
+    if use_copy:
+        cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS '
+            '"%s" (id INTEGER, value %s) ON COMMIT DROP' % (
+                staging, field.storage))
+    param = '?' if backend.name == 'sqlite' else '%s'
+    update = 'UPDATE "%s" SET "%s" = %s WHERE id = %s' % (
+        Model._table, name, param, param)
+    vectors = iter(vectors)
+    done = 0
+    while batch := list(islice(vectors, batch_size)):
+        if use_copy:
+            cursor.execute('TRUNCATE "%s"' % staging)
+            cursor.copy_expert(
+                'COPY "%s" (id, value) FROM STDIN WITH (FORMAT binary)'
+                % staging, _copy_binary(batch, field.storage))
+            cursor.execute('UPDATE "%s" AS t SET "%s" = s.value '
+                'FROM "%s" AS s WHERE t.id = s.id' % (
+                    Model._table, name, staging))
+        else:
+            if backend.name == 'sqlite':
+                values = [(field.sql_format(v), id_) for id_, v in batch]
+            else:
+                values = [('[%s]' % ','.join(repr(float(x)) for x in v), id_)
+                    for id_, v in batch]
+            cursor.executemany(update, values)
+        done += len(batch)
+        if progress:
+            progress(done)
+    return done